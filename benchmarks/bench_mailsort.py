@@ -0,0 +1,283 @@
+"""Micro-benchmarks for the MailSort hot paths.
+
+Measures classify_email and clean_text over seeded synthetic corpora, the
+linear classifier when NumPy is installed, and get_emails against an
+in-process fake Gmail service, reporting emails/sec and per-call latency
+percentiles. Cold-start import time of the core package and of the
+dashboard script is measured in fresh interpreters.
+
+    python benchmarks/bench_mailsort.py --save baseline.json
+    python benchmarks/bench_mailsort.py --compare baseline.json
+
+With --compare, any benchmark whose throughput dropped by more than
+--tolerance is reported and the run exits with status 1.
+"""
+import argparse
+import importlib.util
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WORDS = [
+    'the', 'team', 'project', 'your', 'account', 'please', 'find', 'attached',
+    'report', 'quarter', 'thanks', 'regards', 'update', 'meeting', 'notes',
+    'customer', 'shipping', 'week', 'today', 'tomorrow', 'review', 'draft'
+]
+KEYWORDS = [
+    'security alert', 'payment failed', 'action required', 'legal notice',
+    'meeting request', 'order shipped', 'new comment', 'password reset'
+]
+SPAM = [
+    'congratulations you won', 'claim your prize', 'limited time offer',
+    'buy now', 'flash sale', '100% free', 'unsubscribe', 'save up to', 'act now'
+]
+ENTITIES = ['&amp;', '&lt;', '&gt;', '&quot;', '&#39;', '&nbsp;', '&euro;', '&#x2014;']
+SENDERS = [
+    'GitHub <noreply@github.com>', 'Alice <alice@example.org>',
+    'Deals <promo@shop-now.biz>', 'Google <no-reply@accounts.google.com>',
+    'bob@company.co'
+]
+CORPORA = ('short', 'long', 'entities', 'spam')
+
+
+def make_email(rng, kind):
+    """Build one synthetic (snippet, sender, subject) record of the given kind."""
+    if kind == 'short':
+        words = rng.choices(WORDS, k=rng.randint(5, 30))
+    elif kind == 'long':
+        words = rng.choices(WORDS, k=rng.randint(400, 1200))
+    elif kind == 'entities':
+        words = [w + rng.choice(ENTITIES) for w in rng.choices(WORDS, k=rng.randint(20, 60))]
+    else:
+        words = rng.choices(WORDS + SPAM * 2, k=rng.randint(20, 60))
+    if rng.random() < 0.3:
+        words.insert(rng.randrange(len(words) + 1), rng.choice(KEYWORDS))
+    subject = ' '.join(rng.choices(WORDS + KEYWORDS, k=rng.randint(2, 8))).capitalize()
+    return ' '.join(words), rng.choice(SENDERS), subject
+
+
+def make_corpus(kind, n, seed=0):
+    """Return n reproducible synthetic emails of one kind."""
+    rng = random.Random(f'{kind}-{seed}')
+    return [make_email(rng, kind) for _ in range(n)]
+
+
+class FakeRequest:
+    def __init__(self, fn):
+        self.fn = fn
+
+    def execute(self, http=None, num_retries=0):
+        return self.fn()
+
+
+class FakeBatch:
+    def __init__(self, callback):
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, callback=None, request_id=None):
+        self.requests.append((request_id, request))
+
+    def execute(self, http=None):
+        for request_id, request in self.requests:
+            self.callback(request_id, request.execute(), None)
+
+
+class FakeGmailService:
+    """In-process stand-in for the parts of the Gmail API that get_emails uses."""
+
+    def __init__(self, corpus):
+        self.messages_by_id = {}
+        for i, (snippet, sender, subject) in enumerate(corpus):
+            msg_id = f'{i:016x}'
+            self.messages_by_id[msg_id] = {
+                'id': msg_id,
+                'internalDate': str(1700000000000 - i * 1000),
+                'snippet': snippet[:200],
+                'payload': {'headers': [
+                    {'name': 'Subject', 'value': subject},
+                    {'name': 'From', 'value': sender},
+                    {'name': 'Date', 'value': 'Tue, 14 Nov 2023 22:13:20 +0000'},
+                ]},
+            }
+        self.ids = list(self.messages_by_id)
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(callback)
+
+    def list(self, userId='me', maxResults=100, pageToken=None, **kwargs):
+        def run():
+            start = int(pageToken or 0)
+            result = {'messages': [{'id': msg_id} for msg_id in self.ids[start:start + maxResults]]}
+            if start + maxResults < len(self.ids):
+                result['nextPageToken'] = str(start + maxResults)
+            return result
+        return FakeRequest(run)
+
+    def get(self, userId='me', id=None, **kwargs):
+        return FakeRequest(lambda: self.messages_by_id[id])
+
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def measure(fn, items, per_call_items=1):
+    """Time fn over items, returning throughput and latency percentiles in microseconds."""
+    for item in items[:10]:
+        fn(item)
+    latencies = []
+    started = time.perf_counter()
+    for item in items:
+        t0 = time.perf_counter_ns()
+        fn(item)
+        latencies.append((time.perf_counter_ns() - t0) / 1000)
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        'emails_per_sec': round(len(items) * per_call_items / elapsed, 1),
+        'p50_us': round(percentile(latencies, 0.50), 2),
+        'p90_us': round(percentile(latencies, 0.90), 2),
+        'p99_us': round(percentile(latencies, 0.99), 2),
+    }
+
+
+IMPORT_TARGETS = {
+    'core': 'import mailsort, mailsort.gmail, mailsort.store',
+    # The dashboard script runs in Streamlit's bare mode when imported; it
+    # opens its local store in the working directory, hence the temp cwd.
+    'ui': 'import emailsorter',
+}
+
+
+def measure_import(statement, runs=5):
+    """Median wall time in milliseconds of a statement in a fresh interpreter."""
+    code = f'import time; t = time.perf_counter(); {statement}; print(time.perf_counter() - t)'
+    env = dict(os.environ, PYTHONPATH=ROOT + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    timings = []
+    with tempfile.TemporaryDirectory() as cwd:
+        for _ in range(runs):
+            out = subprocess.run(
+                [sys.executable, '-c', code], cwd=cwd, env=env,
+                capture_output=True, text=True, check=True
+            ).stdout
+            timings.append(float(out.strip().splitlines()[-1]) * 1000)
+    return {'import_ms': round(statistics.median(timings), 1)}
+
+
+def run_benchmarks(n, seed):
+    sys.path.insert(0, ROOT)
+    from mailsort import classify_email, clean_text
+    from mailsort.gmail import FETCH_CONCURRENCY, PooledHttp, get_emails
+    from mailsort.quota import QuotaScheduler, TokenBucket, set_scheduler
+
+    results = {}
+    for kind in CORPORA:
+        corpus = make_corpus(kind, n, seed)
+        results[f'classify_email[{kind}]'] = measure(lambda e: classify_email(*e), corpus)
+        results[f'clean_text[{kind}]'] = measure(lambda e: clean_text(e[0]), corpus)
+
+    if importlib.util.find_spec('numpy'):
+        from mailsort.linear import train
+        # Scored in batches, like the dashboard and the archive classifier do
+        model = train(make_corpus('short', n, seed + 1), epochs=2)
+        batch_size = 500
+        for kind in CORPORA:
+            corpus = make_corpus(kind, n, seed)
+            batches = [corpus[i:i + batch_size] for i in range(0, len(corpus), batch_size)]
+            results[f'classify_linear[{kind}]'] = measure(
+                model.classify_many, batches, per_call_items=batch_size
+            )
+
+    service = FakeGmailService(make_corpus('short', n, seed))
+    # Measure the client-side cost of a fetch, not the pacing to the Gmail quota
+    unpaced = 1e12
+    set_scheduler(service, QuotaScheduler(unpaced, TokenBucket(unpaced)))
+    # The concurrent engine shares the service's pooled transport between its threads
+    service._http = PooledHttp(None)
+    fetch_size = 500
+    rounds = max(1, n // fetch_size)
+    results[f'get_emails[{fetch_size}]'] = measure(
+        lambda _: get_emails(service, fetch_size), range(rounds), per_call_items=fetch_size
+    )
+    results[f'get_emails[{fetch_size}, concurrent]'] = measure(
+        lambda _: get_emails(service, fetch_size, concurrency=FETCH_CONCURRENCY), range(rounds),
+        per_call_items=fetch_size
+    )
+
+    for name, statement in IMPORT_TARGETS.items():
+        results[f'import[{name}]'] = measure_import(statement)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Return the benchmarks that got more than tolerance slower than baseline.
+
+    Throughput results regress when emails/sec drops; import timings regress
+    when milliseconds grow.
+    """
+    regressions = []
+    for name, current in results.items():
+        before = baseline.get(name)
+        if not before:
+            continue
+        if 'import_ms' in current:
+            key, change = 'import_ms', before['import_ms'] / current['import_ms'] - 1
+        else:
+            key, change = 'emails_per_sec', current['emails_per_sec'] / before['emails_per_sec'] - 1
+        if change < -tolerance:
+            regressions.append((name, key, before[key], current[key], change))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--n', type=int, default=5000, help='emails per corpus (default 5000)')
+    parser.add_argument('--seed', type=int, default=0, help='corpus seed (default 0)')
+    parser.add_argument('--save', metavar='PATH', help='write results as a baseline JSON file')
+    parser.add_argument('--compare', metavar='PATH', help='compare against a saved baseline')
+    parser.add_argument('--tolerance', type=float, default=0.10,
+                        help='allowed throughput drop before flagging a regression (default 0.10)')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.n, args.seed)
+    print(f"{'benchmark':<28}{'emails/s':>12}{'p50 us':>10}{'p90 us':>10}{'p99 us':>10}")
+    for name, r in results.items():
+        if 'import_ms' in r:
+            print(f"{name:<28}{'cold start':>12}{r['import_ms']:>9} ms")
+        else:
+            print(f"{name:<28}{r['emails_per_sec']:>12}{r['p50_us']:>10}{r['p90_us']:>10}{r['p99_us']:>10}")
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'n': args.n, 'seed': args.seed, 'results': results}, f, indent=2)
+        print(f"Saved baseline to {args.save}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        for name, key, before, after, change in regressions:
+            print(f"REGRESSION {name}: {key} {before} -> {after} ({change:+.1%})")
+        if regressions:
+            return 1
+        print("No regressions against baseline")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
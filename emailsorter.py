@@ -1,246 +1,235 @@
 import streamlit as st
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
 import html
-import re
+import uuid
+
+from mailsort.accounts import account_name, account_token_path, fetch_accounts, list_accounts
+from mailsort.auth import TokenCache
+from mailsort.classify import ClassificationCache
+from mailsort.columnar import EmailColumns
+from mailsort.gmail import (
+    BODY_MAX_BYTES, FETCH_CONCURRENCY, HTTP_POOL_SIZE, BodyCache, build_service, get_email_body,
+    get_history_id, get_thread_body, stream_emails
+)
+from mailsort.labels import apply_labels
+from mailsort.metrics import METRICS
+from mailsort.search import SearchIndex
+from mailsort.store import get_meta, load_emails, open_store, prune_emails, save_emails, set_meta
+from mailsort.worker import MAX_BACKLOG, POLL_INTERVAL, MailboxWorker, Settings
 
 SCOPES = ['']
 
 
+def authorize():
+    """Run the OAuth consent flow in the browser and return the new credentials."""
+    from google_auth_oauthlib.flow import InstalledAppFlow
+
+    flow = InstalledAppFlow.from_client_secrets_file('credentials.json', SCOPES)
+    return flow.run_local_server(port=0)
+
+
 def gmail_authenticate():
-    """Authenticate the user with Gmail API."""
+    """Authenticate the user with Gmail API, reusing the stored token when there is one."""
     creds = None
-    if 'token' in st.session_state:
-        creds = Credentials.from_authorized_user_info(st.session_state['token'])
-    else:
-        try:
-            flow = InstalledAppFlow.from_client_secrets_file('credentials.json', SCOPES)
-            creds = flow.run_local_server(port=0)
-            st.session_state['token'] = creds.to_json()
-        except Exception as e:
-            st.error(f"Authentication failed: {e}")
+    try:
+        cache = get_token_cache()
+        creds = cache.get()
+        if creds is None:
+            creds = authorize()
+            cache.set(creds)
+    except Exception as e:
+        st.error(f"Authentication failed: {e}")
     return creds
 
 
-def clean_text(text):
-    """Remove invalid or non-displayable characters and decode HTML entities."""
-    if not text:
-        return ""
-    text = html.unescape(text)
-    text = re.sub(r'[\x00-\x08\x0b-\x0c\x0e-\x1f\x7f-\x9f]', '', text)
-    return text.strip()
+def add_account():
+    """Authorize another mailbox for the multi-account view and store its token."""
+    try:
+        creds = authorize()
+        name = account_name(build_service(creds))
+        get_account_token_cache(name).set(creds)
+        st.toast(f"Added {name}")
+    except Exception as e:
+        st.error(f"Adding the account failed: {e}")
+
+
+st.set_page_config(
+    page_title="MailSort  - Email Dashboard",
+    page_icon="📧",
+    layout="wide",
+    initial_sidebar_state="expanded"
+)
+
+
+@st.cache_resource
+def get_token_cache():
+    """One token cache per server, so every session shares the same refresh."""
+    return TokenCache(scopes=SCOPES)
+
+
+ENGINES = ('Rules', 'Linear model')
 
 
-def get_emails(service, max_results=10):
-    """Fetch emails from Gmail inbox."""
+@st.cache_resource
+def get_classification_cache(engine='Rules'):
+    """One classification cache per engine, shared by every session on this server."""
+    if engine == 'Linear model':
+        from mailsort.linear import LinearModel
+
+        model = LinearModel.load()
+        return ClassificationCache(classifier=model.classify_many, version=model.version)
+    return ClassificationCache()
+
+
+def get_classifier():
+    """The classification cache of the engine picked in the sidebar, else the rules."""
+    engine = st.session_state.get('engine', 'Rules')
     try:
-        results = service.users().messages().list(userId='me', maxResults=max_results).execute()
-        messages = results.get('messages', [])
-        emails = []
-
-        for msg in messages:
-            txt = service.users().messages().get(userId='me', id=msg['id'], format='full').execute()
-            headers = txt['payload'].get('headers', [])
-            subject = sender = date = ""
-            for d in headers:
-                n = d.get('name', '').lower()
-                if n == 'subject':
-                    subject = d.get('value', '')
-                elif n == 'from':
-                    sender = d.get('value', '')
-                elif n == 'date':
-                    date = d.get('value', '')
-            snippet = txt.get('snippet', '')
-            emails.append({
-                'id': msg['id'],
-                'sender': clean_text(sender),
-                'subject': clean_text(subject),
-                'snippet': clean_text(snippet),
-                'date': date
-            })
-        return emails
+        return get_classification_cache(engine)
+    except (ImportError, OSError, ValueError) as e:
+        st.session_state.engine_error = f"{engine} unavailable, using rules: {e}"
+        return get_classification_cache('Rules')
 
-    except Exception as e:
-        st.error(f"Error fetching emails: {e}")
-        return []
-
-
-def classify_email(email_text, sender="", subject=""):
-    """Classify email into Urgent, Important, or Other with enhanced accuracy."""
-    text = (email_text or '').lower()
-    sender_lower = (sender or '').lower()
-    subject_lower = (subject or '').lower()
-    combined = text + " " + subject_lower
-
-    # Trusted domains (emails from these are less likely to be spam)
-    trusted_domains = [
-        'google.com', 'microsoft.com', 'apple.com', 'amazon.com',
-        'paypal.com', 'github.com', 'gitlab.com', 'linkedin.com',
-        'facebook.com', 'twitter.com', 'instagram.com', 'netflix.com',
-        'dropbox.com', 'slack.com', 'zoom.us', 'adobe.com',
-        'salesforce.com', 'stripe.com', 'atlassian.com', 'notion.so'
-    ]
-    is_trusted = any(domain in sender_lower for domain in trusted_domains)
-
-    urgent_security = [
-        'security alert', 'security warning', 'suspicious activity', 'unusual activity',
-        'unauthorized access', 'unusual sign-in', 'new login', 'login from',
-        'verify your account', 'confirm your identity', 'account verification required',
-        'password reset required', 'password changed', 'password reset',
-        'suspicious login', 'login attempt', 'failed login', 'unusual location',
-        'verification code', 'two-factor', '2fa', 'authentication code',
-        'account locked', 'account disabled', 'account compromised',
-        'data breach', 'security incident', 'fraud alert'
-    ]
-
-    urgent_financial = [
-        'payment failed', 'payment declined', 'card declined', 'transaction failed',
-        'payment overdue', 'subscription cancelled', 'subscription ending',
-        'account suspended', 'service suspended', 'outstanding balance',
-        'invoice overdue', 'payment bounced', 'insufficient funds',
-        'billing issue', 'payment issue', 'auto-pay failed',
-        'final notice', 'last warning', 'account will be closed'
-    ]
-
-    urgent_action = [
-        'action required', 'immediate action', 'respond immediately',
-        'urgent', 'asap', 'time sensitive', 'time-sensitive',
-        'expires today', 'expiring soon', 'deadline today',
-        'critical', 'emergency', 'important notice',
-        'requires immediate attention', 'needs your attention'
-    ]
-
-    urgent_legal = [
-        'legal notice', 'court notice', 'legal action',
-        'lawsuit', 'violation', 'compliance required',
-        'regulatory notice', 'tax notice', 'irs notice'
-    ]
-
-    important_work = [
-        'meeting request', 'meeting invite', 'calendar invitation',
-        'schedule', 'appointment', 'interview', 'call scheduled',
-        'project update', 'status update', 'progress report',
-        'review required', 'approval needed', 'please review',
-        'feedback requested', 'input needed', 'action needed',
-        'task assigned', 'assigned to you', 'deadline',
-        'proposal', 'contract', 'agreement', 'document to sign',
-        'performance review', 'annual review', '1:1 meeting'
-    ]
-
-    important_personal = [
-        'order confirmation', 'order shipped', 'delivery update',
-        'tracking information', 'package delivered', 'out for delivery',
-        'booking confirmation', 'reservation confirmed', 'ticket',
-        'appointment reminder', 'reservation reminder',
-        'invoice', 'receipt', 'payment confirmation',
-        'subscription renewal', 'membership renewal',
-        'password reset', 'verification email', 'confirm email'
-    ]
-
-    important_updates = [
-        'new message', 'direct message', 'you have been mentioned',
-        'comment on', 'replied to', 'new comment', 'new reply',
-        'shared with you', 'invited you', 'added you',
-        'requested to', 'wants to', 'sent you',
-        'notification from', 'update from', 'news from'
-    ]
-
-    spam_obvious = [
-        'congratulations you won', 'you won', 'claim your prize', 'winner',
-        'you\'ve been selected', 'selected winner', 'lucky winner',
-        'click here now', 'click below', 'click this link',
-        'act now', 'order now', 'buy now', 'shop now',
-        'make money fast', 'make $$', 'earn money', 'work from home',
-        'lose weight fast', 'weight loss miracle', 'diet pill',
-        'viagra', 'cialis', 'pharmacy', 'prescription',
-        'casino', 'lottery', 'gambling', 'poker',
-        'risk free', '100% free', 'absolutely free',
-        'no credit check', 'no strings attached',
-        'billion dollars', 'million dollars', 'inheritance',
-        'nigerian prince', 'transfer funds', 'bank transfer'
-    ]
-
-    spam_marketing = [
-        'limited time offer', 'offer expires', 'today only',
-        'don\'t miss out', 'last chance', 'hurry up',
-        'exclusive deal', 'special offer', 'amazing deal',
-        'lowest price', 'best price', 'price drop',
-        'sale ends', 'flash sale', 'clearance sale',
-        'up to % off', '% discount', 'save up to',
-        'free trial', 'try for free', 'no obligation'
-    ]
-
-    promotional = [
-        'newsletter', 'weekly digest', 'monthly update',
-        'new arrivals', 'latest collection', 'new products',
-        'recommendations for you', 'you might like',
-        'based on your', 'personalized for you',
-        'trending now', 'popular items', 'best sellers',
-        'unsubscribe', 'manage preferences', 'email preferences'
-    ]
-
-    is_newsletter = any(word in combined for word in ['newsletter', 'digest', 'weekly roundup', 'unsubscribe'])
-    is_marketing = any(word in combined for word in ['shop', 'sale', 'discount', 'deal', 'offer'])
-
-    urgent_security_count = sum(1 for keyword in urgent_security if keyword in combined)
-    urgent_financial_count = sum(1 for keyword in urgent_financial if keyword in combined)
-    urgent_action_count = sum(1 for keyword in urgent_action if keyword in combined)
-    urgent_legal_count = sum(1 for keyword in urgent_legal if keyword in combined)
-
-    if urgent_security_count >= 1 or urgent_legal_count >= 1:
-        return "Urgent"
-    
-    if urgent_financial_count >= 1 and is_trusted:
-        return "Urgent"
-    
-    if urgent_action_count >= 1 and not is_marketing:
-        return "Urgent"
 
-    spam_obvious_count = sum(1 for keyword in spam_obvious if keyword in combined)
-    spam_marketing_count = sum(1 for keyword in spam_marketing if keyword in combined)
+ROWS_PER_PAGE = 100
+# How often an open page checks the background worker for a new snapshot
+WORKER_CHECK_SECONDS = 5
 
-    if spam_obvious_count >= 2:
-        return "Other"
-    
-    if not is_trusted and spam_marketing_count >= 3:
-        return "Other"
 
-    important_work_count = sum(1 for keyword in important_work if keyword in combined)
-    important_personal_count = sum(1 for keyword in important_personal if keyword in combined)
-    important_updates_count = sum(1 for keyword in important_updates if keyword in combined)
+@st.cache_resource(max_entries=16)
+def get_gmail_service(account_key, _creds):
+    """Build the Gmail service once per credential and share it across reruns and sessions."""
+    return build_service(_creds)
 
-    if important_work_count >= 1 and not is_newsletter:
-        return "Important"
-    
-    if important_personal_count >= 1 and is_trusted:
-        return "Important"
-    
-    if important_updates_count >= 1 and not is_marketing:
-        return "Important"
 
-    promotional_count = sum(1 for keyword in promotional if keyword in combined)
-    if is_newsletter or promotional_count >= 2 or is_marketing:
-        return "Other"
+@st.cache_resource(max_entries=64)
+def get_account_token_cache(name):
+    """One token cache per added account, shared by every session."""
+    return TokenCache(account_token_path(name), SCOPES)
 
-    if is_trusted and not is_marketing:
-        return "Important"
 
-    return "Other"
+def get_service_for(email):
+    """The Gmail service that can read email: its own account's in the combined view."""
+    name = email.get('account')
+    if name is None:
+        return st.session_state.get('service')
+    creds = get_account_token_cache(name).get()
+    return creds and get_gmail_service(('account', name), creds)
 
 
-st.set_page_config(
-    page_title="MailSort  - Email Dashboard",
-    page_icon="📧",
-    layout="wide",
-    initial_sidebar_state="expanded"
-)
+@st.cache_resource(max_entries=16)
+def get_mailbox_worker(account_key, _service):
+    """One background poll worker per account, shared by every session."""
+    return MailboxWorker(_service)
+
+
+def to_columns(emails):
+    """Classify emails and pack them into the columnar form the dashboard keeps."""
+    classifier = get_classifier()
+    return EmailColumns(emails, classifier.classify(emails), classifier.version)
+
+
+def toggle_metrics():
+    """Apply this session's metrics checkbox to the process-wide collector."""
+    METRICS.enabled = st.session_state.metrics_enabled
+
+
+def mark_emails_changed():
+    """Give the loaded emails a new version so cached table pages are redrawn."""
+    st.session_state.data_version = uuid.uuid4().hex
+
 
+def get_search_index():
+    """Return the session's search index, brought up to date with the loaded emails."""
+    index = st.session_state.get('search_index')
+    if index is None:
+        index = st.session_state.search_index = SearchIndex()
+    if st.session_state.get('search_index_version') != st.session_state.data_version:
+        with METRICS.timer('index'):
+            index.sync(st.session_state.emails)
+        st.session_state.search_index_version = st.session_state.data_version
+    return index
 
-if 'emails' not in st.session_state:
-    st.session_state.emails = []
+
+@st.cache_data(max_entries=64)
+def render_table_page(view, query, page, data_version, _rows, account=None):
+    """Build one HTML fragment for a page of (email, category) rows.
+
+    Cached per (view, query, page, data_version, account); _rows is not hashed.
+    """
+    parts = ["""
+    <div class='email-table'>
+        <div class='email-header'>
+            <div>SUBJECT</div>
+            <div>SENDER</div>
+            <div>URGENCY</div>
+        </div>
+    """]
+    if not _rows:
+        parts.append(f"""
+        <div style='padding: 3rem; text-align: center; color: var(--text-secondary);'>
+            {'No emails match your search' if query else 'No emails in this category'}
+        </div>
+        """)
+    for email, category in _rows:
+        subject = email['subject'][:80]
+        if email.get('thread_size', 0) > 1:
+            subject += f" ({email['thread_size']})"
+        badge_class = f"badge-{category.lower()}"
+        row_class = category.lower()
+        sender_display = email['sender'].split('<')[0].strip() if '<' in email['sender'] else email['sender']
+        account_line = f"<br><small>{html.escape(email['account'])}</small>" if 'account' in email else ''
+        parts.append(f"""
+        <div class='email-row {row_class}'>
+            <div class='email-subject'>{html.escape(subject)}</div>
+            <div class='email-sender'>{html.escape(sender_display[:50])}{account_line}</div>
+            <div><span class='badge {badge_class}'>{category}</span></div>
+        </div>
+        """)
+    parts.append("</div>")
+    return ''.join(parts)
+
+
+if 'store' not in st.session_state:
+    # Open straight from the local store; the network is only touched on fetch
+    st.session_state.store = open_store()
+    st.session_state.emails = to_columns(load_emails(st.session_state.store))
+    st.session_state.history_id = get_meta(st.session_state.store, 'history_id')
+    mark_emails_changed()
 if 'current_view' not in st.session_state:
     st.session_state.current_view = 'Inbox'
+if 'mode' not in st.session_state:
+    # 'threads' when the store holds one row per conversation
+    st.session_state.mode = get_meta(st.session_state.store, 'mode', 'messages')
+if 'bodies' not in st.session_state:
+    st.session_state.bodies = BodyCache()
+if 'fetch_stream' not in st.session_state:
+    st.session_state.fetch_stream = None
+
+
+def worker_has_news():
+    """Whether the background worker published a snapshot this session has not adopted yet."""
+    worker = st.session_state.get('worker')
+    if worker is None or st.session_state.fetch_stream is not None:
+        return False
+    version = worker.snapshot.version
+    return version > 0 and version != st.session_state.get('snapshot_version')
+
+
+@st.fragment(run_every=WORKER_CHECK_SECONDS)
+def watch_worker():
+    """Rerun the page when the background worker publishes new mail."""
+    if worker_has_news():
+        st.rerun()
+
+
+# Adopt the worker's latest snapshot; it is shared by reference, never copied
+if worker_has_news():
+    snapshot = st.session_state.worker.snapshot
+    st.session_state.snapshot_version = snapshot.version
+    st.session_state.emails = snapshot.emails
+    st.session_state.history_id = snapshot.history_id
+    st.session_state.mode = 'threads' if snapshot.threads else 'messages'
+    mark_emails_changed()
 
 st.markdown("""
 <style>
@@ -298,14 +287,11 @@ st.markdown("""
     }
 
     /* Main content area */
-    .main-header {
+    .st-key-main_header {
         background: var(--bg-secondary);
         padding: 1.5rem 2rem;
         border-radius: 12px;
         margin-bottom: 1.5rem;
-        display: flex;
-        justify-content: space-between;
-        align-items: center;
         box-shadow: 0 1px 3px rgba(0,0,0,0.1);
     }
 
@@ -316,25 +302,6 @@ st.markdown("""
         margin: 0;
     }
 
-    .search-box {
-        background: var(--bg-tertiary);
-        border: 1px solid var(--border-color);
-        border-radius: 8px;
-        padding: 0.75rem 1rem;
-        display: flex;
-        align-items: center;
-        gap: 0.5rem;
-        min-width: 300px;
-    }
-
-    .search-box input {
-        background: transparent;
-        border: none;
-        color: var(--text-primary);
-        outline: none;
-        width: 100%;
-    }
-
     /* Email table */
     .email-table {
         background: var(--bg-secondary);
@@ -530,41 +497,198 @@ with st.sidebar:
     st.markdown("<br><br>", unsafe_allow_html=True)
    
     st.markdown("### ⚙️ Settings")
-    email_count = st.slider("Emails to fetch", 5, 50, 15, 5)
+    fetch_all = st.checkbox("Fetch entire mailbox")
+    email_count = st.number_input(
+        "Emails to fetch", min_value=5, max_value=100000, value=15, step=5, disabled=fetch_all
+    )
     
+    incremental = st.checkbox(
+        "Incremental sync", value=True,
+        help="The background sync is shared by every session; these settings apply when you next fetch"
+    )
+    poll_interval = st.number_input(
+        "Poll every (seconds)", min_value=10, max_value=3600, value=POLL_INTERVAL, step=10,
+        disabled=not incremental
+    )
+    max_backlog = st.number_input(
+        "Max new emails per poll", min_value=10, max_value=10000, value=MAX_BACKLOG, step=10,
+        disabled=not incremental
+    )
+    classify_bodies = st.checkbox(
+        "Classify message bodies", help="Downloads full messages; only new mail is affected"
+    )
+    body_bytes = st.number_input(
+        "Body bytes to read", min_value=1024, max_value=256 * 1024, value=BODY_MAX_BYTES, step=1024,
+        disabled=not classify_bodies
+    )
+    body_bytes = int(body_bytes) if classify_bodies else 0
+    group_threads = st.checkbox(
+        "Group by conversation", value=st.session_state.mode == 'threads',
+        help="One row per thread, classified as a whole; changing this refetches the mailbox"
+    )
+    mode = 'threads' if group_threads else 'messages'
+    concurrent_fetch = st.checkbox(
+        "Concurrent requests", disabled=group_threads,
+        help="Fetch messages with parallel single requests instead of batch requests"
+    )
+    # More requests than the service's pooled connections would only queue for one
+    concurrency = st.number_input(
+        "Requests in flight", min_value=1, max_value=HTTP_POOL_SIZE, value=FETCH_CONCURRENCY, step=1,
+        disabled=group_threads or not concurrent_fetch
+    )
+    concurrency = int(concurrency) if concurrent_fetch and not group_threads else None
+    st.selectbox(
+        "Classifier", ENGINES, key="engine",
+        help="The linear model needs NumPy and a model trained with `python -m mailsort.linear`"
+    )
+    if st.session_state.emails.version != get_classifier().version:
+        # The engine changed: categorize the loaded emails again, once
+        st.session_state.emails = to_columns(list(st.session_state.emails))
+        mark_emails_changed()
+    if 'engine_error' in st.session_state:
+        st.warning(st.session_state.pop('engine_error'))
+    # Handed to the shared worker only when this session starts or restarts it
+    sync_settings = Settings(
+        poll_interval, int(max_backlog), get_classifier(), body_bytes, st.session_state.mode == 'threads'
+    )
+    # The collector is shared by every session: show its current state and only write it on a click here
+    st.session_state.metrics_enabled = METRICS.enabled
+    st.checkbox("Collect performance metrics", key="metrics_enabled", on_change=toggle_metrics,
+                help="Applies to every session on this server")
+
     st.markdown("<br>", unsafe_allow_html=True)
     
     if st.button("🔄 Connect & Fetch", key="fetch", use_container_width=True):
-        creds = gmail_authenticate()
+        with METRICS.timer('authenticate'):
+            creds = gmail_authenticate()
         if creds:
-            service = build('gmail', 'v1', credentials=creds)
-            with st.spinner("Fetching emails..."):
-                st.session_state.emails = get_emails(service, email_count)
-            if st.session_state.emails:
-                st.success(f"✓ Fetched {len(st.session_state.emails)} emails")
+            account_key = (creds.client_id, creds.refresh_token or creds.token)
+            service = get_gmail_service(account_key, creds)
+            st.session_state.service = service
+            worker = st.session_state.worker = get_mailbox_worker(account_key, service)
+            can_sync = incremental and st.session_state.emails and st.session_state.mode == mode \
+                and st.session_state.fetch_stream is None and st.session_state.get('history_id')
+            if can_sync:
+                # The worker fetches the changes; the page picks them up once they are published
+                worker.start(st.session_state.emails, st.session_state.history_id, sync_settings)
+                st.toast("Checking for new mail in the background")
+            else:
+                # No usable history (first fetch, sync disabled or expired historyId): full resync.
+                # The worker is shared with other sessions; it is restarted from this fetch once it completes.
+                try:
+                    st.session_state.pending_history_id = get_history_id(service)
+                except Exception:
+                    st.session_state.pending_history_id = None
+                known = {}
+                if st.session_state.mode == mode:
+                    known = {email['id']: email for email in st.session_state.emails if 'account' not in email}
+                else:
+                    # Rows of the other mode are of no use; drop their history until this fetch completes
+                    st.session_state.mode = mode
+                    set_meta(st.session_state.store, 'mode', mode)
+                    set_meta(st.session_state.store, 'history_id', None)
+                st.session_state.history_id = None
+                st.session_state.emails = EmailColumns(version=get_classifier().version)
+                mark_emails_changed()
+                st.session_state.fetch_stream = stream_emails(
+                    service, None if fetch_all else int(email_count), known=known, concurrency=concurrency,
+                    body_bytes=body_bytes, threads=mode == 'threads', bodies=st.session_state.bodies
+                )
                 st.rerun()
 
+    st.markdown("### 👥 Accounts")
+    accounts = st.multiselect(
+        "Mailboxes", list_accounts(), key="accounts", placeholder="Add a mailbox to fetch several at once",
+        help="Each mailbox is fetched and classified in its own process, then shown in one combined view"
+    )
+    col1, col2 = st.columns(2)
+    with col1:
+        if st.button("➕ Add", key="account_add", use_container_width=True):
+            add_account()
+    with col2:
+        fetch_selected = st.button(
+            "Fetch selected", key="accounts_fetch", disabled=not accounts, use_container_width=True
+        )
+    if fetch_selected:
+        # The combined view replaces this session's single mailbox; the shared worker keeps polling for the others
+        st.session_state.pop('worker', None)
+        st.session_state.fetch_stream = None
+        rows = []
+        progress = st.progress(0.0, text=f"Fetching {len(accounts)} mailboxes...")
+        results = fetch_accounts(
+            accounts, max_results=None if fetch_all else int(email_count), concurrency=concurrency,
+            body_bytes=body_bytes, threads=mode == 'threads'
+        )
+        for done, (name, account_emails, error) in enumerate(results, 1):
+            if error:
+                st.warning(f"{name}: {error}")
+            rows.extend(account_emails)
+            progress.progress(done / len(accounts), text=f"Fetched {done} of {len(accounts)} mailboxes")
+        rows.sort(key=lambda email: email.get('ts', 0), reverse=True)
+        st.session_state.emails = to_columns(rows)
+        st.session_state.history_id = None
+        mark_emails_changed()
+
+    # Write the categories back to the mailboxes; conversation rows have no single message to label
+    labelable = bool(st.session_state.emails) and not any(st.session_state.emails.thread_sizes) \
+        and ('service' in st.session_state or any(st.session_state.emails.accounts))
+    if st.button(
+        "🏷️ Apply labels in Gmail", key="apply_labels", disabled=not labelable, use_container_width=True,
+        help="Labels every loaded message MailSort/Urgent, MailSort/Important or MailSort/Other; "
+             "messages that already have the right label are skipped"
+    ):
+        emails = st.session_state.emails
+        rows = list(emails)
+        by_account = {}
+        for row in rows:
+            by_account.setdefault(row.get('account'), []).append(row)
+        changed = {}
+        try:
+            with st.spinner("Applying labels..."):
+                for name, account_rows in by_account.items():
+                    service = get_service_for(account_rows[0])
+                    if service is None:
+                        st.warning(f"Sign in to {name or 'Gmail'} again to label its mail")
+                        continue
+                    changed.update(apply_labels(service, account_rows))
+        except Exception as e:
+            st.error(f"Applying labels failed: {e}")
+        else:
+            st.toast(f"Labelled {len(changed)} emails; {len(rows) - len(changed)} already had their label")
+        if changed:
+            for row in rows:
+                if row['id'] in changed:
+                    row['labels'] = changed[row['id']]
+            # Rows of other accounts live in their own stores and are refreshed with them
+            save_emails(st.session_state.store,
+                        [row for row in rows if row['id'] in changed and 'account' not in row])
+            st.session_state.emails = EmailColumns(rows, [row['category'] for row in rows], emails.version)
+            mark_emails_changed()
+
+    worker = st.session_state.get('worker')
+    if worker is not None:
+        if worker.running and st.button(
+            "⏹ Stop background sync", key="sync_stop", use_container_width=True,
+            help="Stops polling this mailbox for every session on this server"
+        ):
+            worker.stop()
+            st.rerun()
+        if worker.snapshot.error:
+            st.warning(worker.snapshot.error)
+
     # Statistics
-    if st.session_state.emails:
+    emails = st.session_state.emails
+    if emails:
         st.markdown("<br><br>", unsafe_allow_html=True)
         st.markdown("### 📊 Statistics")
         
-        classified = []
-        for email in st.session_state.emails:
-            category = classify_email(
-                email['snippet'], 
-                email['sender'],
-                email['subject']
-            )
-            classified.append({**email, 'category': category})
-
-        urgent_count = sum(1 for e in classified if e['category'] == 'Urgent')
-        important_count = sum(1 for e in classified if e['category'] == 'Important')
-        other_count = sum(1 for e in classified if e['category'] == 'Other')
+        urgent_count = emails.count('Urgent')
+        important_count = emails.count('Important')
+        other_count = emails.count('Other')
 
         st.markdown(f"""
         <div class='stat-box'>
-            <div class='stat-number'>{len(classified)}</div>
+            <div class='stat-number'>{len(emails)}</div>
             <div class='stat-label'>Total</div>
         </div>
         """, unsafe_allow_html=True)
@@ -587,68 +711,120 @@ with st.sidebar:
             </div>
             """, unsafe_allow_html=True)
 
-st.markdown(f"""
-<div class='main-header'>
-    <h1 class='page-title'>{st.session_state.current_view}</h1>
-    <div class='search-box'>
-        <span>🔍</span>
-        <input type='text' placeholder='Search mail' readonly />
-    </div>
-</div>
-""", unsafe_allow_html=True)
-
-if st.session_state.emails:
-
-    classified = []
-    for email in st.session_state.emails:
-        category = classify_email(
-            email['snippet'], 
-            email['sender'],
-            email['subject']
-        )
-        classified.append({**email, 'category': category})
-
-    # Filter based on current view
+    if METRICS.enabled:
+        st.markdown("<br><br>", unsafe_allow_html=True)
+        st.markdown("### ⏱️ Performance")
+        stages, counters = METRICS.snapshot()
+        if stages:
+            st.markdown("\n".join(
+                f"- **{stage}**: {calls} × {total / calls * 1000:.1f} ms avg, {total * 1000:.0f} ms total"
+                for stage, (calls, total, _) in sorted(stages.items())
+            ))
+        api_calls = sum(v for (name, _), v in counters.items() if name == 'api_calls')
+        received = sum(v for (name, _), v in counters.items() if name == 'bytes_received')
+        st.caption(f"API calls: {api_calls:g} · Received: {received / 1024:.1f} KiB")
+        rates = []
+        for cache in ('classification_cache', 'body_cache', 'store'):
+            rate = METRICS.hit_rate(cache)
+            if rate is not None:
+                rates.append(f"{cache.replace('_', ' ')} {rate:.0%}")
+        if rates:
+            st.caption("Hit rates: " + " · ".join(rates))
+        col1, col2 = st.columns(2)
+        with col1:
+            st.download_button("JSON lines", METRICS.to_jsonl(), "mailsort-metrics.jsonl",
+                               use_container_width=True)
+        with col2:
+            st.download_button("Prometheus", METRICS.to_prometheus(), "mailsort-metrics.prom",
+                               use_container_width=True)
+        if st.button("Reset metrics", key="metrics_reset", use_container_width=True):
+            METRICS.reset()
+            st.rerun()
+
+with st.container(key="main_header"):
+    col1, col2 = st.columns([3, 2], vertical_alignment="center")
+    with col1:
+        st.markdown(f"<h1 class='page-title'>{st.session_state.current_view}</h1>",
+                    unsafe_allow_html=True)
+    with col2:
+        query = st.text_input(
+            "Search mail", key="search", placeholder="🔍 Search mail", label_visibility="collapsed"
+        ).strip()
+
+if emails:
+
+    # In a combined multi-account view, optionally narrow it to one mailbox
+    account = None
+    account_names = sorted(set(emails.accounts) - {None})
+    if account_names:
+        account = st.selectbox("Mailbox", account_names, index=None, placeholder="All mailboxes",
+                               key="account_filter")
+
+    # Filter based on current view: row positions into the email columns
     if st.session_state.current_view == 'Inbox':
-        filtered = classified
+        filtered = emails.select(account=account)
     elif st.session_state.current_view in ['Urgent', 'Important', 'Other']:
-        filtered = [e for e in classified if e['category'] == st.session_state.current_view]
+        filtered = emails.select(st.session_state.current_view, account)
     else:
         filtered = []
+    if query and filtered:
+        hits = get_search_index().search(query)
+        ids = emails.ids
+        filtered = [i for i in filtered if ids[i] in hits]
+
+    # Email table, one HTML fragment per page
+    view = st.session_state.current_view
+    page_count = max(1, -(-len(filtered) // ROWS_PER_PAGE))
+    if st.session_state.get('page_view') != (view, query, account):
+        st.session_state.page_view = (view, query, account)
+        st.session_state.page = 0
+    page = min(st.session_state.get('page', 0), page_count - 1)
+    rows = [(emails.row(i), emails.category(i))
+            for i in filtered[page * ROWS_PER_PAGE:(page + 1) * ROWS_PER_PAGE]]
+    with METRICS.timer('render'):
+        st.markdown(
+            render_table_page(view, query, page, st.session_state.data_version, rows, account),
+            unsafe_allow_html=True
+        )
 
-    # Email table
-    st.markdown("""
-    <div class='email-table'>
-        <div class='email-header'>
-            <div>SUBJECT</div>
-            <div>SENDER</div>
-            <div>URGENCY</div>
-        </div>
-    """, unsafe_allow_html=True)
-
-    if len(filtered) == 0:
-        st.markdown("""
-        <div style='padding: 3rem; text-align: center; color: var(--text-secondary);'>
-            No emails in this category
-        </div>
-        """, unsafe_allow_html=True)
-    else:
-        for email in filtered:
-            category = email['category']
-            badge_class = f"badge-{category.lower()}"
-            row_class = category.lower()
-           
-            sender_display = email['sender'].split('<')[0].strip() if '<' in email['sender'] else email['sender']
-            
-            st.markdown(f"""
-            <div class='email-row {row_class}'>
-                <div class='email-subject'>{html.escape(email['subject'][:80])}</div>
-                <div class='email-sender'>{html.escape(sender_display[:50])}</div>
-                <div><span class='badge {badge_class}'>{category}</span></div>
-            </div>
-            """, unsafe_allow_html=True)
+    if page_count > 1:
+        col1, col2, col3 = st.columns([1, 2, 1])
+        with col1:
+            if st.button("← Previous", key="page_prev", disabled=page == 0, use_container_width=True):
+                st.session_state.page = page - 1
+                st.rerun()
+        with col2:
+            st.markdown(
+                f"<div style='text-align: center; color: var(--text-secondary);'>"
+                f"Page {page + 1} of {page_count} · {len(filtered)} emails</div>",
+                unsafe_allow_html=True
+            )
+        with col3:
+            if st.button("Next →", key="page_next", disabled=page == page_count - 1,
+                         use_container_width=True):
+                st.session_state.page = page + 1
+                st.rerun()
 
-    st.markdown("</div>", unsafe_allow_html=True)
+    if rows and ('service' in st.session_state or account_names):
+        by_id = {e['id']: e for e, _ in rows}
+        opened = st.selectbox(
+            "Open message", list(by_id), index=None,
+            format_func=lambda msg_id: by_id[msg_id]['subject'] or '(no subject)',
+            placeholder="Select a message to read"
+        )
+        if opened:
+            try:
+                email = by_id[opened]
+                service = get_service_for(email)
+                if service is None:
+                    body = "(sign in to this mailbox again to read it)"
+                elif email.get('thread_size'):
+                    body = get_thread_body(service, opened, st.session_state.bodies, email['ts'])
+                else:
+                    body = get_email_body(service, opened, st.session_state.bodies)
+                st.text(body or "(empty message)")
+            except Exception as e:
+                st.error(f"Error loading message: {e}")
 
 else:
     st.markdown("""
@@ -658,4 +834,43 @@ else:
         <br>
         <p style='font-size: 0.9rem;'>🔒 Secure OAuth2 • 🤖 AI Sorting • ⚡ Fast Preview</p>
     </div>
-    """, unsafe_allow_html=True)
\ No newline at end of file
+    """, unsafe_allow_html=True)
+
+# Pull the next page of a running fetch after the current page has been drawn,
+# then rerun so the table grows page by page.
+if st.session_state.fetch_stream is not None:
+    try:
+        with st.spinner(f"Fetching emails... {len(st.session_state.emails)} so far"):
+            page = next(st.session_state.fetch_stream, None)
+        complete = page is None
+    except Exception as e:
+        st.error(f"Error fetching emails: {e}. Fetch again to resume; the emails fetched so far are kept.")
+        page = None
+        complete = False
+    if page is None:
+        st.session_state.fetch_stream = None
+        store = st.session_state.store
+        history_id = st.session_state.pop('pending_history_id', None)
+        if complete:
+            prune_emails(store, st.session_state.emails.ids)
+            st.session_state.history_id = history_id
+            if history_id:
+                set_meta(store, 'history_id', history_id)
+                if incremental and 'worker' in st.session_state:
+                    st.session_state.worker.restart(st.session_state.emails, history_id, sync_settings)
+        if complete and st.session_state.emails:
+            st.toast(f"✓ Fetched {len(st.session_state.emails)} emails")
+    else:
+        save_emails(st.session_state.store, page)
+        st.session_state.emails.extend(page, get_classifier().classify(page))
+        mark_emails_changed()
+        if 'search_index' in st.session_state:
+            # Index just the new page rather than resyncing the whole mailbox
+            st.session_state.search_index.add(page)
+            st.session_state.search_index_version = st.session_state.data_version
+        st.rerun()
+
+# Let the page notice mail published by the background worker on its own
+if st.session_state.fetch_stream is None and 'worker' in st.session_state \
+        and st.session_state.worker.running:
+    watch_worker()
@@ -0,0 +1,5 @@
+"""MailSort core: email text cleaning and classification without the dashboard."""
+from .classify import RULESET_VERSION, classify_email, classify_many
+from .text import clean_text
+
+__all__ = ['RULESET_VERSION', 'classify_email', 'classify_many', 'clean_text']
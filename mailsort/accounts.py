@@ -0,0 +1,111 @@
+"""Multi-account fetching: each account's mailbox in its own worker process.
+
+Every account has its own token file and store under ACCOUNTS_DIR. A
+fetch runs the whole fetch and classify pipeline for one account in a
+separate process, with its own credentials and interpreter, so several
+mailboxes are fetched and classified in parallel across CPU cores.
+"""
+from concurrent.futures import as_completed
+import logging
+import os
+
+from .auth import TOKEN_DIR, TokenCache
+from .pool import process_pool
+
+logger = logging.getLogger(__name__)
+
+ACCOUNTS_DIR = os.path.join(TOKEN_DIR, 'accounts')
+
+
+def account_token_path(name, accounts_dir=ACCOUNTS_DIR):
+    return os.path.join(accounts_dir, f'{name}.json')
+
+
+def account_store_path(name, accounts_dir=ACCOUNTS_DIR):
+    return os.path.join(accounts_dir, f'{name}.db')
+
+
+def list_accounts(accounts_dir=ACCOUNTS_DIR):
+    """Return the names of the accounts with a stored token, sorted."""
+    try:
+        names = os.listdir(accounts_dir)
+    except FileNotFoundError:
+        return []
+    return sorted(name[:-len('.json')] for name in names if name.endswith('.json'))
+
+
+def account_name(service):
+    """Return the address of the mailbox behind service, used as its account name."""
+    from .quota import scheduler_for
+
+    request = service.users().getProfile(userId='me')
+    return scheduler_for(service).execute('getProfile', request)['emailAddress']
+
+
+def fetch_account(name, max_results=None, concurrency=None, body_bytes=0, threads=False,
+                  accounts_dir=ACCOUNTS_DIR, project_rate=None):
+    """Fetch and classify one account's mailbox into its own store.
+
+    Meant to run in a worker process. Stored emails are reused like on a
+    full resync in the dashboard. project_rate caps the process's use of
+    the project quota, in units per second. Returns the emails, each
+    tagged with the account name under 'account'.
+    """
+    from .gmail import HTTP_POOL_SIZE, build_service, get_history_id, stream_emails
+    from .quota import set_project_rate
+    from .store import get_meta, load_emails, open_store, prune_emails, save_emails, set_meta
+
+    if project_rate:
+        set_project_rate(project_rate)
+    cache = TokenCache(account_token_path(name, accounts_dir))
+    creds = cache.get()
+    if creds is None:
+        raise RuntimeError(f"{name} has to be signed in again")
+    mode = 'threads' if threads else 'messages'
+    conn = open_store(account_store_path(name, accounts_dir))
+    try:
+        # One pooled connection per request in flight
+        service = build_service(creds, max(HTTP_POOL_SIZE, concurrency or 0))
+        history_id = get_history_id(service)
+        known = {}
+        if get_meta(conn, 'mode', 'messages') == mode:
+            known = {email['id']: email for email in load_emails(conn)}
+        emails = []
+        for page in stream_emails(service, max_results, known=known, concurrency=concurrency,
+                                  body_bytes=body_bytes, threads=threads):
+            save_emails(conn, page)
+            emails.extend(page)
+        prune_emails(conn, [email['id'] for email in emails])
+        set_meta(conn, 'mode', mode)
+        set_meta(conn, 'history_id', history_id)
+    finally:
+        conn.close()
+        cache.close()
+    for email in emails:
+        email['account'] = name
+    return emails
+
+
+def fetch_accounts(names, processes=None, **options):
+    """Fetch several accounts in parallel, one process each, yielding (name, emails, error) as each finishes.
+
+    options are passed on to fetch_account. Each process gets an equal
+    share of the project quota, so together they stay within it. A failing
+    account is reported with its error and does not stop the others.
+    """
+    from .quota import PROJECT_RATE
+
+    if not names:
+        return
+    processes = min(len(names), processes or os.cpu_count() or 1)
+    options.setdefault('project_rate', PROJECT_RATE / processes)
+    # Spawned, not forked, and without re-running the dashboard script in each process
+    with process_pool(processes) as pool:
+        futures = {pool.submit(fetch_account, name, **options): name for name in names}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                yield name, future.result(), None
+            except Exception as e:
+                logger.warning("Fetching %s failed", name, exc_info=True)
+                yield name, [], str(e)
@@ -0,0 +1,118 @@
+"""Streaming readers for mbox files, Maildir directories and .eml files."""
+from email.header import decode_header, make_header
+from email.parser import BytesParser
+from email.policy import compat32
+import mmap
+import os
+
+from .text import clean_text, extract_headers, strip_html
+
+# Only the start of each message is parsed: headers and the first text part
+# are all classification needs, and the cap keeps memory flat on huge mails.
+MAX_MESSAGE_BYTES = 256 * 1024
+SNIPPET_LENGTH = 200
+HEADER_NAMES = ('Subject', 'From', 'Date')
+
+_parser = BytesParser(policy=compat32)
+
+
+def iter_mbox(path):
+    """Yield (key, raw bytes) for each message of an mbox file, read through mmap."""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            pos = 0 if mm[:5] == b'From ' else mm.find(b'\nFrom ') + 1
+            if mm[pos:pos + 5] != b'From ':
+                return
+            while pos < len(mm):
+                next_from = mm.find(b'\nFrom ', pos)
+                end = len(mm) if next_from < 0 else next_from + 1
+                start = mm.find(b'\n', pos, end) + 1 or end
+                yield f'{path}:{pos}', mm[start:min(end, start + MAX_MESSAGE_BYTES)]
+                pos = end
+
+
+def iter_maildir(path):
+    """Yield (key, raw bytes) for each message in a Maildir's cur and new folders."""
+    for folder in ('cur', 'new'):
+        folder_path = os.path.join(path, folder)
+        if not os.path.isdir(folder_path):
+            continue
+        for name in sorted(os.listdir(folder_path)):
+            file_path = os.path.join(folder_path, name)
+            if os.path.isfile(file_path):
+                with open(file_path, 'rb') as f:
+                    yield file_path, f.read(MAX_MESSAGE_BYTES)
+
+
+def iter_eml(path):
+    """Yield (key, raw bytes) for an .eml file, or for every .eml file under a directory."""
+    if os.path.isfile(path):
+        with open(path, 'rb') as f:
+            yield path, f.read(MAX_MESSAGE_BYTES)
+        return
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            if name.lower().endswith('.eml'):
+                yield from iter_eml(os.path.join(root, name))
+
+
+def iter_archive(path):
+    """Yield (key, raw bytes) for every message in an mbox, Maildir or .eml archive."""
+    if os.path.isdir(path):
+        if all(os.path.isdir(os.path.join(path, sub)) for sub in ('cur', 'new', 'tmp')):
+            return iter_maildir(path)
+        return iter_eml(path)
+    if path.lower().endswith('.eml'):
+        return iter_eml(path)
+    return iter_mbox(path)
+
+
+def _decode_header(value):
+    try:
+        return str(make_header(decode_header(value)))
+    except Exception:
+        return str(value)
+
+
+def _snippet(msg):
+    """Return the first SNIPPET_LENGTH characters of the message text, like Gmail's snippet."""
+    plain = rich = None
+    for part in msg.walk():
+        if part.is_multipart() or part.get_filename():
+            continue
+        content_type = part.get_content_type()
+        if content_type == 'text/plain':
+            plain = part
+            break
+        if content_type == 'text/html' and rich is None:
+            rich = part
+    part = plain if plain is not None else rich
+    if part is None:
+        return ""
+    payload = part.get_payload(decode=True) or b''
+    text = payload[:SNIPPET_LENGTH * 16].decode(part.get_content_charset() or 'utf-8', 'replace')
+    if part.get_content_type() == 'text/html':
+        text = strip_html(text)
+    return ' '.join(text.split())[:SNIPPET_LENGTH]
+
+
+def parse_message(key, data):
+    """Extract the dashboard's email fields from raw RFC 822 bytes."""
+    msg = _parser.parsebytes(data)
+    subject, sender, date = extract_headers(
+        (name, _decode_header(msg[name])) for name in HEADER_NAMES if name in msg
+    )
+    try:
+        snippet = _snippet(msg)
+    except (LookupError, ValueError):
+        snippet = ""
+    return {
+        'id': (msg.get('Message-ID') or key).strip(),
+        'sender': clean_text(sender),
+        'subject': clean_text(subject),
+        'snippet': clean_text(snippet),
+        'date': date
+    }
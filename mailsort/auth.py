@@ -0,0 +1,169 @@
+"""Durable OAuth token cache with proactive, shared refresh.
+
+The authorized-user token (including the refresh token) is kept in a file
+only the current user can read. Access tokens are refreshed in the
+background shortly before they expire, so fetches never wait on the token
+endpoint. A thread lock and an advisory file lock make concurrent sessions
+and worker processes for the same account share one refresh.
+"""
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import json
+import logging
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows: fall back to the in-process lock only
+    fcntl = None
+
+from .metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+TOKEN_DIR = os.path.join(os.path.expanduser('~'), '.mailsort')
+TOKEN_PATH = os.path.join(TOKEN_DIR, 'token.json')
+# Refresh this many seconds before the access token expires
+REFRESH_MARGIN = 300
+REFRESH_RETRY = 30
+
+
+def _seconds_left(creds):
+    if creds.expiry is None:
+        return float('inf')
+    # google-auth keeps expiry as a naive UTC datetime
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    return (creds.expiry - now).total_seconds()
+
+
+def load_token(path=TOKEN_PATH, scopes=None):
+    """Return the credentials stored at path, or None if there are none."""
+    from google.oauth2.credentials import Credentials
+
+    try:
+        with open(path, encoding='utf-8') as f:
+            info = json.load(f)
+    except (OSError, ValueError):
+        return None
+    try:
+        return Credentials.from_authorized_user_info(info, scopes)
+    except ValueError:
+        logger.warning("Ignoring malformed token file %s", path)
+        return None
+
+
+def save_token(creds, path=TOKEN_PATH):
+    """Atomically write creds to path, readable by the current user only."""
+    os.makedirs(os.path.dirname(path) or '.', mode=0o700, exist_ok=True)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        f.write(creds.to_json())
+    os.replace(tmp, path)
+
+
+@contextmanager
+def _file_lock(path):
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(os.path.dirname(path) or '.', mode=0o700, exist_ok=True)
+    fd = os.open(f'{path}.lock', os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+class TokenCache:
+    """Credentials for one token file, shared by every session and worker.
+
+    get() hands out the same Credentials object every time and refreshes it
+    in place, so services built on it pick up new access tokens for free.
+    """
+
+    def __init__(self, path=TOKEN_PATH, scopes=None, margin=REFRESH_MARGIN):
+        self.path = path
+        self.scopes = scopes
+        self.margin = margin
+        self.creds = None
+        self.lock = threading.Lock()
+        self.timer = None
+
+    def get(self):
+        """Return valid credentials, or None if the account was never authorized."""
+        with self.lock:
+            if self.creds is None:
+                self.creds = load_token(self.path, self.scopes)
+                if self.creds is None:
+                    return None
+            if _seconds_left(self.creds) < self.margin:
+                from google.auth.exceptions import RefreshError
+
+                try:
+                    self._refresh()
+                except RefreshError:
+                    # Revoked or expired refresh token: the user has to sign in again
+                    logger.warning("Stored token for %s can no longer be refreshed", self.path)
+                    self.creds = None
+                    return None
+            self._schedule()
+            return self.creds
+
+    def set(self, creds):
+        """Store freshly authorized credentials and keep them refreshed."""
+        with self.lock:
+            with _file_lock(self.path):
+                save_token(creds, self.path)
+            self.creds = creds
+            self._schedule()
+
+    def close(self):
+        """Stop the background refresh."""
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+    def _refresh(self):
+        # Caller holds self.lock. Another process may have refreshed while we
+        # waited for the file lock; adopt its token instead of refreshing again.
+        from google.auth.transport.requests import Request
+
+        with _file_lock(self.path):
+            stored = load_token(self.path, self.scopes)
+            if stored is not None and _seconds_left(stored) >= self.margin:
+                self.creds.token = stored.token
+                self.creds.expiry = stored.expiry
+                return
+            if not self.creds.refresh_token:
+                return
+            with METRICS.timer('token_refresh'):
+                self.creds.refresh(Request())
+            save_token(self.creds, self.path)
+
+    def _schedule(self, delay=None):
+        # Caller holds self.lock
+        if not self.creds.refresh_token or (self.timer is not None and self.timer.is_alive()):
+            return
+        if delay is None:
+            delay = _seconds_left(self.creds) - self.margin
+            if delay == float('inf'):
+                return
+        self.timer = threading.Timer(max(delay, 0), self._background_refresh)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def _background_refresh(self):
+        with self.lock:
+            self.timer = None
+            try:
+                self._refresh()
+            except Exception:
+                logger.warning("Background token refresh failed; retrying in %ss",
+                               REFRESH_RETRY, exc_info=True)
+                self._schedule(REFRESH_RETRY)
+                return
+            self._schedule()
@@ -0,0 +1,342 @@
+"""Rule-based Urgent / Important / Other classification."""
+from collections import OrderedDict
+from functools import lru_cache
+import hashlib
+import json
+import os
+import threading
+
+from .metrics import METRICS
+from .pool import process_pool
+
+# Trusted domains (emails from these are less likely to be spam)
+TRUSTED_DOMAINS = [
+    'google.com', 'microsoft.com', 'apple.com', 'amazon.com',
+    'paypal.com', 'github.com', 'gitlab.com', 'linkedin.com',
+    'facebook.com', 'twitter.com', 'instagram.com', 'netflix.com',
+    'dropbox.com', 'slack.com', 'zoom.us', 'adobe.com',
+    'salesforce.com', 'stripe.com', 'atlassian.com', 'notion.so'
+]
+
+KEYWORD_GROUPS = {
+    'urgent_security': [
+        'security alert', 'security warning', 'suspicious activity', 'unusual activity',
+        'unauthorized access', 'unusual sign-in', 'new login', 'login from',
+        'verify your account', 'confirm your identity', 'account verification required',
+        'password reset required', 'password changed', 'password reset',
+        'suspicious login', 'login attempt', 'failed login', 'unusual location',
+        'verification code', 'two-factor', '2fa', 'authentication code',
+        'account locked', 'account disabled', 'account compromised',
+        'data breach', 'security incident', 'fraud alert'
+    ],
+    'urgent_financial': [
+        'payment failed', 'payment declined', 'card declined', 'transaction failed',
+        'payment overdue', 'subscription cancelled', 'subscription ending',
+        'account suspended', 'service suspended', 'outstanding balance',
+        'invoice overdue', 'payment bounced', 'insufficient funds',
+        'billing issue', 'payment issue', 'auto-pay failed',
+        'final notice', 'last warning', 'account will be closed'
+    ],
+    'urgent_action': [
+        'action required', 'immediate action', 'respond immediately',
+        'urgent', 'asap', 'time sensitive', 'time-sensitive',
+        'expires today', 'expiring soon', 'deadline today',
+        'critical', 'emergency', 'important notice',
+        'requires immediate attention', 'needs your attention'
+    ],
+    'urgent_legal': [
+        'legal notice', 'court notice', 'legal action',
+        'lawsuit', 'violation', 'compliance required',
+        'regulatory notice', 'tax notice', 'irs notice'
+    ],
+    'important_work': [
+        'meeting request', 'meeting invite', 'calendar invitation',
+        'schedule', 'appointment', 'interview', 'call scheduled',
+        'project update', 'status update', 'progress report',
+        'review required', 'approval needed', 'please review',
+        'feedback requested', 'input needed', 'action needed',
+        'task assigned', 'assigned to you', 'deadline',
+        'proposal', 'contract', 'agreement', 'document to sign',
+        'performance review', 'annual review', '1:1 meeting'
+    ],
+    'important_personal': [
+        'order confirmation', 'order shipped', 'delivery update',
+        'tracking information', 'package delivered', 'out for delivery',
+        'booking confirmation', 'reservation confirmed', 'ticket',
+        'appointment reminder', 'reservation reminder',
+        'invoice', 'receipt', 'payment confirmation',
+        'subscription renewal', 'membership renewal',
+        'password reset', 'verification email', 'confirm email'
+    ],
+    'important_updates': [
+        'new message', 'direct message', 'you have been mentioned',
+        'comment on', 'replied to', 'new comment', 'new reply',
+        'shared with you', 'invited you', 'added you',
+        'requested to', 'wants to', 'sent you',
+        'notification from', 'update from', 'news from'
+    ],
+    'spam_obvious': [
+        'congratulations you won', 'you won', 'claim your prize', 'winner',
+        'you\'ve been selected', 'selected winner', 'lucky winner',
+        'click here now', 'click below', 'click this link',
+        'act now', 'order now', 'buy now', 'shop now',
+        'make money fast', 'make $$', 'earn money', 'work from home',
+        'lose weight fast', 'weight loss miracle', 'diet pill',
+        'viagra', 'cialis', 'pharmacy', 'prescription',
+        'casino', 'lottery', 'gambling', 'poker',
+        'risk free', '100% free', 'absolutely free',
+        'no credit check', 'no strings attached',
+        'billion dollars', 'million dollars', 'inheritance',
+        'nigerian prince', 'transfer funds', 'bank transfer'
+    ],
+    'spam_marketing': [
+        'limited time offer', 'offer expires', 'today only',
+        'don\'t miss out', 'last chance', 'hurry up',
+        'exclusive deal', 'special offer', 'amazing deal',
+        'lowest price', 'best price', 'price drop',
+        'sale ends', 'flash sale', 'clearance sale',
+        'up to % off', '% discount', 'save up to',
+        'free trial', 'try for free', 'no obligation'
+    ],
+    'promotional': [
+        'newsletter', 'weekly digest', 'monthly update',
+        'new arrivals', 'latest collection', 'new products',
+        'recommendations for you', 'you might like',
+        'based on your', 'personalized for you',
+        'trending now', 'popular items', 'best sellers',
+        'unsubscribe', 'manage preferences', 'email preferences'
+    ],
+    'newsletter': ['newsletter', 'digest', 'weekly roundup', 'unsubscribe'],
+    'marketing': ['shop', 'sale', 'discount', 'deal', 'offer'],
+}
+
+
+def build_matcher(groups):
+    """Compile keyword groups into a single Aho-Corasick automaton.
+
+    The automaton is returned as a DFA: transitions[state] maps a character to
+    the next state (characters not in it lead back to the root), and
+    outputs[state] lists the keywords that end at that state.
+    """
+    keywords = {}
+    for group, words in groups.items():
+        for word in words:
+            keywords.setdefault(word, []).append(group)
+    goto = [{}]
+    outputs = [set()]
+    for index, word in enumerate(keywords):
+        state = 0
+        for ch in word:
+            if ch not in goto[state]:
+                goto.append({})
+                outputs.append(set())
+                goto[state][ch] = len(goto) - 1
+            state = goto[state][ch]
+        outputs[state].add(index)
+
+    # Breadth-first pass: resolve failure links and fold them into full transitions
+    alphabet = {ch for word in keywords for ch in word}
+    transitions = [dict(goto[0])] + [None] * (len(goto) - 1)
+    fail = [0] * len(goto)
+    queue = list(goto[0].values())
+    for state in queue:
+        outputs[state] |= outputs[fail[state]]
+        row = {}
+        for ch in alphabet:
+            child = goto[state].get(ch)
+            if child is None:
+                target = transitions[fail[state]].get(ch, 0)
+            else:
+                target = child
+                fail[child] = transitions[fail[state]].get(ch, 0)
+                queue.append(child)
+            if target:
+                row[ch] = target
+        transitions[state] = row
+    groups_by_keyword = [tuple(groups_of) for groups_of in keywords.values()]
+    return transitions, [tuple(out) for out in outputs], groups_by_keyword, tuple(groups)
+
+
+def match_counts(matcher, text):
+    """Count, per group, how many distinct keywords occur in text, in one pass."""
+    transitions, outputs, groups_by_keyword, group_names = matcher
+    state = 0
+    hits = set()
+    for ch in text:
+        state = transitions[state].get(ch, 0)
+        if outputs[state]:
+            hits.update(outputs[state])
+    counts = dict.fromkeys(group_names, 0)
+    for index in hits:
+        for group in groups_by_keyword[index]:
+            counts[group] += 1
+    return counts
+
+
+KEYWORD_MATCHER = build_matcher(KEYWORD_GROUPS)
+TRUSTED_DOMAIN_SET = frozenset(TRUSTED_DOMAINS)
+SENDER_CACHE_SIZE = 65536
+# Bumped when the rules change in ways the keyword lists do not show
+RULES_REVISION = 2
+# Changes whenever a keyword list changes, so stored and cached categories go stale with it
+RULESET_VERSION = hashlib.sha1(
+    json.dumps([RULES_REVISION, TRUSTED_DOMAINS, KEYWORD_GROUPS], sort_keys=True).encode()
+).hexdigest()[:12]
+
+
+def sender_domain(sender):
+    """Return the lower-cased domain of a From header such as 'Name <user@example.com>'."""
+    address = sender.rsplit('<', 1)[-1].split('>', 1)[0]
+    return address.rpartition('@')[2].strip().lower() if '@' in address else ''
+
+
+@lru_cache(maxsize=SENDER_CACHE_SIZE)
+def is_trusted_sender(sender):
+    """Whether the sender's domain is a trusted domain or one of its subdomains.
+
+    Cached per sender: a mailbox has far fewer senders than messages.
+    """
+    labels = sender_domain(sender).split('.')
+    return any('.'.join(labels[i:]) in TRUSTED_DOMAIN_SET for i in range(len(labels) - 1))
+
+
+def classify_email(email_text, sender="", subject="", body=""):
+    """Classify email into Urgent, Important, or Other with enhanced accuracy."""
+    text = (email_text or '').lower()
+    sender_lower = (sender or '').lower()
+    subject_lower = (subject or '').lower()
+    combined = text + " " + subject_lower
+    if body:
+        combined += " " + body.lower()
+
+    is_trusted = is_trusted_sender(sender_lower)
+    counts = match_counts(KEYWORD_MATCHER, combined)
+    is_newsletter = counts['newsletter'] > 0
+    is_marketing = counts['marketing'] > 0
+
+    if counts['urgent_security'] >= 1 or counts['urgent_legal'] >= 1:
+        return "Urgent"
+    
+    if counts['urgent_financial'] >= 1 and is_trusted:
+        return "Urgent"
+    
+    if counts['urgent_action'] >= 1 and not is_marketing:
+        return "Urgent"
+
+    if counts['spam_obvious'] >= 2:
+        return "Other"
+    
+    if not is_trusted and counts['spam_marketing'] >= 3:
+        return "Other"
+
+    if counts['important_work'] >= 1 and not is_newsletter:
+        return "Important"
+    
+    if counts['important_personal'] >= 1 and is_trusted:
+        return "Important"
+    
+    if counts['important_updates'] >= 1 and not is_marketing:
+        return "Important"
+
+    if is_newsletter or counts['promotional'] >= 2 or is_marketing:
+        return "Other"
+
+    if is_trusted and not is_marketing:
+        return "Important"
+
+    return "Other"
+
+
+CLASSIFY_CHUNK_SIZE = 5000
+PARALLEL_THRESHOLD = 20000
+
+
+def _classify_chunk(records):
+    return [classify_email(*record) for record in records]
+
+
+def classify_many(emails, processes=None, chunk_size=CLASSIFY_CHUNK_SIZE):
+    """Classify (snippet, sender, subject[, body]) records, returning the categories in order.
+
+    Batches of PARALLEL_THRESHOLD records or more are split into chunks and
+    classified across a process pool; smaller ones run in this process.
+    """
+    records = list(emails)
+    METRICS.count('classified', len(records))
+    processes = processes or os.cpu_count() or 1
+    with METRICS.timer('classify_email'):
+        if processes == 1 or len(records) < PARALLEL_THRESHOLD:
+            return _classify_chunk(records)
+        chunks = [records[i:i + chunk_size] for i in range(0, len(records), chunk_size)]
+        with process_pool(processes) as pool:
+            return [category for result in pool.map(_classify_chunk, chunks) for category in result]
+
+
+def label_emails(emails):
+    """Set 'category' on emails not yet classified under the current ruleset.
+
+    A 'body' fetched for body-aware classification is used here and then
+    dropped, so bodies are never kept or stored.
+    """
+    stale = []
+    records = []
+    for email in emails:
+        body = email.pop('body', '')
+        if email.get('ruleset') != RULESET_VERSION:
+            stale.append(email)
+            records.append((email['snippet'], email['sender'], email['subject'], body))
+    categories = classify_many(records)
+    for email, category in zip(stale, categories):
+        email['category'] = category
+        email['ruleset'] = RULESET_VERSION
+    return emails
+
+
+CLASSIFY_CACHE_SIZE = 200000
+
+
+class ClassificationCache:
+    """Thread-safe LRU of categories keyed by (id, timestamp, classifier version).
+
+    The timestamp makes a conversation that gained a reply count as new.
+    Rules are the default classifier; any callable taking (snippet, sender,
+    subject) records, such as LinearModel.classify_many, can stand in with
+    its own version string.
+    """
+
+    def __init__(self, max_size=CLASSIFY_CACHE_SIZE, classifier=classify_many, version=RULESET_VERSION):
+        self.max_size = max_size
+        self.classifier = classifier
+        self.version = version
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def classify(self, emails):
+        """Return the categories of emails, classifying each one once per classifier version."""
+        version = self.version
+        categories = [None] * len(emails)
+        missing = []
+        with self.lock:
+            for i, email in enumerate(emails):
+                key = (email['id'], email.get('ts'), version)
+                category = self.entries.get(key)
+                if category is None and email.get('ruleset') == version:
+                    category = self.entries[key] = email['category']
+                if category is None:
+                    missing.append(i)
+                else:
+                    self.entries.move_to_end(key)
+                    categories[i] = category
+        METRICS.count('classification_cache_hits', len(emails) - len(missing))
+        METRICS.count('classification_cache_misses', len(missing))
+        if missing:
+            computed = self.classifier(
+                (emails[i]['snippet'], emails[i]['sender'], emails[i]['subject']) for i in missing
+            )
+            with self.lock:
+                for i, category in zip(missing, computed):
+                    self.entries[(emails[i]['id'], emails[i].get('ts'), version)] = category
+                    categories[i] = category
+                while len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+        return categories
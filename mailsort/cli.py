@@ -0,0 +1,127 @@
+"""Headless bulk classification of exported mail archives.
+
+    python -m mailsort archive.mbox ~/Maildir exported/ -o categories.csv
+
+Archives may be mbox files, Maildir directories, .eml files or directories
+of .eml files. Messages are streamed in batches, so memory stays flat no
+matter how large the archive is.
+"""
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import csv
+from functools import lru_cache
+from itertools import chain, islice
+import json
+import os
+import sys
+import time
+
+from .archive import iter_archive, parse_message
+from .classify import classify_many
+
+ARCHIVE_BATCH_SIZE = 500
+FIELDS = ['id', 'date', 'sender', 'subject', 'category']
+
+
+@lru_cache(maxsize=None)
+def _load_model(path):
+    from .linear import LinearModel
+    return LinearModel.load(path)
+
+
+def _classify_batch(batch, model_path=None):
+    records = [parse_message(key, data) for key, data in batch]
+    texts = [(r['snippet'], r['sender'], r['subject']) for r in records]
+    if model_path:
+        categories = _load_model(model_path).classify_many(texts)
+    else:
+        categories = classify_many(texts, processes=1)
+    for record, category in zip(records, categories):
+        record['category'] = category
+    return records
+
+
+def _batches(items, size):
+    items = iter(items)
+    while True:
+        batch = list(islice(items, size))
+        if not batch:
+            return
+        yield batch
+
+
+def classify_archives(paths, jobs=1, batch_size=ARCHIVE_BATCH_SIZE, model_path=None):
+    """Yield classified email records for every message in the archives, in order.
+
+    With jobs > 1, batches are parsed and classified in a process pool with
+    at most two batches per worker in flight. With model_path, a LinearModel
+    classifies each batch instead of the rules.
+    """
+    batches = _batches(chain.from_iterable(iter_archive(path) for path in paths), batch_size)
+    if jobs <= 1:
+        for batch in batches:
+            yield from _classify_batch(batch, model_path)
+        return
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        pending = deque()
+        for batch in batches:
+            pending.append(pool.submit(_classify_batch, batch, model_path))
+            if len(pending) >= jobs * 2:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def write_records(records, out, fmt):
+    """Write records as CSV or JSON lines, returning how many were written."""
+    count = 0
+    if fmt == 'csv':
+        writer = csv.DictWriter(out, FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        for record in records:
+            writer.writerow(record)
+            count += 1
+    else:
+        for record in records:
+            out.write(json.dumps({k: record[k] for k in FIELDS}, ensure_ascii=False) + '\n')
+            count += 1
+    return count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m mailsort', description='Classify mail archives offline.'
+    )
+    parser.add_argument('archives', nargs='+', help='mbox files, Maildir directories or .eml files')
+    parser.add_argument('-o', '--output', help='output file (default: stdout)')
+    parser.add_argument('-f', '--format', choices=['csv', 'jsonl'],
+                        help='output format (default: from the output extension, else csv)')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help='worker processes (default: CPU count)')
+    parser.add_argument('--batch-size', type=int, default=ARCHIVE_BATCH_SIZE,
+                        help=f'messages per batch (default {ARCHIVE_BATCH_SIZE})')
+    parser.add_argument('--model', metavar='PATH',
+                        help='classify with a linear model from python -m mailsort.linear instead of the rules')
+    args = parser.parse_args(argv)
+
+    fmt = args.format
+    if fmt is None:
+        fmt = 'jsonl' if (args.output or '').endswith(('.jsonl', '.json')) else 'csv'
+    missing = [path for path in args.archives if not os.path.exists(path)]
+    if missing:
+        parser.error(f"no such archive: {', '.join(missing)}")
+    if args.model and not os.path.exists(args.model):
+        parser.error(f"no such model: {args.model}")
+
+    started = time.perf_counter()
+    records = classify_archives(args.archives, args.jobs, args.batch_size, args.model)
+    if args.output:
+        with open(args.output, 'w', newline='', encoding='utf-8') as out:
+            count = write_records(records, out, fmt)
+    else:
+        count = write_records(records, sys.stdout, fmt)
+    elapsed = time.perf_counter() - started
+    print(f"Classified {count} emails in {elapsed:.1f}s ({count / max(elapsed, 1e-9):.0f}/s)",
+          file=sys.stderr)
+    return 0
@@ -0,0 +1,109 @@
+"""Column-oriented in-memory store for the dashboard's emails."""
+from array import array
+from itertools import compress
+
+from .classify import RULESET_VERSION
+
+CATEGORIES = ('Urgent', 'Important', 'Other')
+CATEGORY_CODES = {name: code for code, name in enumerate(CATEGORIES)}
+# bytes.translate tables turning category codes into a 0/1 selection mask
+_MASKS = {
+    name: bytes(int(code == CATEGORY_CODES[name]) for code in range(256)) for name in CATEGORIES
+}
+
+
+class EmailColumns:
+    """Emails held as parallel columns instead of one dict per message.
+
+    Senders are interned, categories are one-byte codes and the count per
+    category is kept up to date as rows are appended, so counting is O(1)
+    and selecting a category is one bytes.translate plus itertools.compress.
+    Iterating yields plain email dicts, built on demand, for code that works
+    on the fetch and store format.
+    """
+
+    __slots__ = ('ids', 'senders', 'subjects', 'snippets', 'dates', 'ts', 'thread_sizes', 'accounts',
+                 'labels', 'codes', 'counts', 'version', '_sender_pool')
+
+    def __init__(self, emails=(), categories=(), version=RULESET_VERSION):
+        self.ids = []
+        self.senders = []
+        self.subjects = []
+        self.snippets = []
+        self.dates = []
+        self.ts = array('q')
+        # Messages per conversation; 0 for rows that are single messages
+        self.thread_sizes = array('I')
+        # Account of each row in a combined multi-account view, else None
+        self.accounts = []
+        # Space-separated user label ids of each row; few distinct values, so interned
+        self.labels = []
+        self.codes = bytearray()
+        self.counts = [0] * len(CATEGORIES)
+        # Version of the classifier that produced the categories
+        self.version = version
+        self._sender_pool = {}
+        self.extend(emails, categories)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return map(self.row, range(len(self.ids)))
+
+    def extend(self, emails, categories):
+        """Append emails with their categories."""
+        pool = self._sender_pool
+        for email, category in zip(emails, categories):
+            code = CATEGORY_CODES[category]
+            sender = email['sender']
+            self.ids.append(email['id'])
+            self.senders.append(pool.setdefault(sender, sender))
+            self.subjects.append(email['subject'])
+            self.snippets.append(email['snippet'])
+            self.dates.append(email['date'])
+            self.ts.append(email.get('ts') or 0)
+            self.thread_sizes.append(email.get('thread_size') or 0)
+            account = email.get('account')
+            self.accounts.append(account and pool.setdefault(account, account))
+            labels = email.get('labels', '')
+            self.labels.append(pool.setdefault(labels, labels))
+            self.codes.append(code)
+            self.counts[code] += 1
+
+    def count(self, category):
+        return self.counts[CATEGORY_CODES[category]]
+
+    def select(self, category=None, account=None):
+        """Return the row positions in category, or every row position, optionally of one account."""
+        if category is None:
+            positions = range(len(self.ids))
+        else:
+            positions = list(compress(range(len(self.codes)), self.codes.translate(_MASKS[category])))
+        if account is not None:
+            accounts = self.accounts
+            positions = [i for i in positions if accounts[i] == account]
+        return positions
+
+    def category(self, i):
+        return CATEGORIES[self.codes[i]]
+
+    def row(self, i):
+        """Return row i as an email dict in the fetch and store format."""
+        email = {
+            'id': self.ids[i],
+            'sender': self.senders[i],
+            'subject': self.subjects[i],
+            'snippet': self.snippets[i],
+            'date': self.dates[i],
+            'ts': self.ts[i],
+            'category': CATEGORIES[self.codes[i]],
+            'ruleset': self.version
+        }
+        if self.thread_sizes[i]:
+            email['thread_size'] = self.thread_sizes[i]
+        if self.accounts[i] is not None:
+            email['account'] = self.accounts[i]
+        if self.labels[i]:
+            email['labels'] = self.labels[i]
+        return email
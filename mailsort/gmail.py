@@ -0,0 +1,527 @@
+"""Gmail fetching: batched and concurrent message or thread retrieval, paging and history sync.
+
+The Google client libraries are imported only when a service is built or a
+request needs them, so importing this module stays cheap. Every request
+goes through the service's QuotaScheduler, which paces it to the Gmail
+quota and retries rate-limit and server errors.
+"""
+import asyncio
+import base64
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import queue
+import threading
+
+from .classify import label_emails
+from .metrics import METRICS
+from .quota import MAX_RETRIES, is_retryable, scheduler_for
+from .text import clean_text, extract_headers, strip_html
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 50
+MAX_BATCH_SIZE = 100
+BATCH_RETRIES = MAX_RETRIES
+METADATA_HEADERS = ['Subject', 'From', 'Date']
+METADATA_FIELDS = 'id,labelIds,internalDate,snippet,payload/headers'
+BODY_FIELDS = 'id,payload'
+FULL_FIELDS = 'id,labelIds,internalDate,snippet,payload'
+THREAD_METADATA_FIELDS = 'id,messages(id,labelIds,internalDate,snippet,payload/headers)'
+THREAD_FULL_FIELDS = 'id,messages(id,labelIds,internalDate,snippet,payload)'
+THREAD_BODY_FIELDS = 'messages(labelIds,payload)'
+# Opened or prefetched message bodies kept per session
+BODY_CACHE_SIZE = 2000
+# Snippets of this many earlier messages are classified along with a conversation's latest one
+THREAD_SNIPPETS = 5
+# Body-aware classification reads at most this many decoded bytes of each body
+BODY_MAX_BYTES = 8 * 1024
+PAGE_SIZE = 100
+FETCH_CONCURRENCY = 8
+HTTP_POOL_SIZE = FETCH_CONCURRENCY
+HISTORY_TYPES = ['messageAdded', 'messageDeleted', 'labelAdded', 'labelRemoved']
+# messages.list leaves out spam and trash, so these labels move a message out of the set
+HIDDEN_LABELS = {'SPAM', 'TRASH'}
+# Ids of user-created labels start with this; system labels such as INBOX are not kept
+USER_LABEL_PREFIX = 'Label_'
+
+
+def parse_email(txt, body_bytes=0, bodies=None):
+    """Extract the fields shown in the dashboard from a Gmail message resource.
+
+    With body_bytes, up to that many bytes of body text are added under
+    'body' for label_emails to classify with, and the whole body goes into
+    the bodies cache if one is given, so opening the message does not
+    download it again.
+    """
+    with METRICS.timer('clean_text'):
+        email = _parse_email(txt)
+        if body_bytes:
+            payload = txt.get('payload', {})
+            email['body'] = ' '.join(extract_body(payload, body_bytes).split())
+            if bodies is not None:
+                bodies[email['id']] = extract_body(payload)
+        return email
+
+
+def _parse_email(txt):
+    headers = txt.get('payload', {}).get('headers', [])
+    subject, sender, date = extract_headers((d.get('name', ''), d.get('value', '')) for d in headers)
+    snippet = txt.get('snippet', '')
+    email = {
+        'id': txt['id'],
+        'sender': clean_text(sender),
+        'subject': clean_text(subject),
+        'snippet': clean_text(snippet),
+        'date': date,
+        'ts': int(txt.get('internalDate', 0))
+    }
+    labels = ' '.join(label for label in txt.get('labelIds', ()) if label.startswith(USER_LABEL_PREFIX))
+    if labels:
+        # Lets apply_labels skip messages that already carry their category's label
+        email['labels'] = labels
+    return email
+
+
+def message_params(body_bytes=0):
+    """messages.get parameters: headers only, or the full payload when bodies are classified."""
+    if body_bytes:
+        return {'format': 'full', 'fields': FULL_FIELDS}
+    return {'format': 'metadata', 'metadataHeaders': METADATA_HEADERS, 'fields': METADATA_FIELDS}
+
+
+def thread_params(body_bytes=0):
+    """threads.get parameters, the thread counterpart of message_params."""
+    if body_bytes:
+        return {'format': 'full', 'fields': THREAD_FULL_FIELDS}
+    return {'format': 'metadata', 'metadataHeaders': METADATA_HEADERS, 'fields': THREAD_METADATA_FIELDS}
+
+
+def _visible_messages(thread):
+    return [msg for msg in thread.get('messages', []) if not HIDDEN_LABELS & set(msg.get('labelIds', []))]
+
+
+def parse_thread(thread, body_bytes=0, bodies=None):
+    """Return one dashboard row for a Gmail thread resource, or None if all of it is hidden.
+
+    The row shows the latest message under the thread's id, with the number
+    of messages as 'thread_size'. Snippets of the earlier messages go into
+    'body' next to the latest body, so label_emails classifies the whole
+    conversation once.
+    """
+    messages = _visible_messages(thread)
+    if not messages:
+        return None
+    email = parse_email(messages[-1], body_bytes)
+    email['id'] = thread['id']
+    if body_bytes and bodies is not None:
+        # Keyed like get_thread_body
+        bodies[('thread', thread['id'], email['ts'])] = extract_body(messages[-1].get('payload', {}))
+    email['thread_size'] = len(messages)
+    earlier = [clean_text(msg.get('snippet', '')) for msg in messages[-THREAD_SNIPPETS - 1:-1]]
+    if earlier:
+        email['body'] = ' '.join(filter(None, [email.get('body', '')] + earlier))
+    return email
+
+
+def _is_missing(error):
+    """Whether error is Gmail's answer for a message or thread that no longer exists."""
+    return getattr(getattr(error, 'resp', None), 'status', None) == 404
+
+
+def fetch_messages(service, ids, batch_size=BATCH_SIZE, retries=BATCH_RETRIES, resource='messages',
+                   missing_ok=False, **params):
+    """Fetch message resources with Gmail batch requests, in the order of ids.
+
+    With resource='threads', thread resources are fetched instead. Sub-requests
+    that hit a rate limit or a server error inside a batch are collected and
+    only they are retried in a new batch, after a backoff, up to `retries`
+    times before the last error is raised; any other error is raised at
+    once. With missing_ok, ids that no longer exist come back as None instead.
+    """
+    batch_size = max(1, min(batch_size, MAX_BATCH_SIZE))
+    method = f'{resource}.get'
+    scheduler = scheduler_for(service)
+    results = {}
+    errors = {}
+
+    def callback(request_id, response, exception):
+        if exception is None:
+            results[request_id] = response
+            errors.pop(request_id, None)
+        elif missing_ok and _is_missing(exception):
+            results[request_id] = None
+            errors.pop(request_id, None)
+        else:
+            errors[request_id] = exception
+
+    pending = list(dict.fromkeys(ids))
+    for attempt in range(retries + 1):
+        if attempt:
+            scheduler.throttled(attempt - 1)
+        for start in range(0, len(pending), batch_size):
+            chunk = pending[start:start + batch_size]
+            batch = service.new_batch_http_request(callback=callback)
+            get = getattr(service.users(), resource)().get
+            for msg_id in chunk:
+                batch.add(get(userId='me', id=msg_id, **params), request_id=msg_id)
+            with METRICS.timer(method):
+                scheduler.execute(method, batch, count=len(chunk))
+            METRICS.count('api_calls', len(chunk), method=method)
+            METRICS.count('http_requests', kind='batch')
+        pending = [msg_id for msg_id in pending if msg_id in errors]
+        for msg_id in pending:
+            if not is_retryable(errors[msg_id]):
+                raise errors[msg_id]
+        if not pending:
+            break
+    if pending:
+        raise errors[pending[0]]
+    return [results[msg_id] for msg_id in ids]
+
+
+class PooledHttp:
+    """Thread-safe transport that lends out a pool of keep-alive httplib2 connections.
+
+    httplib2.Http objects are not thread-safe, so each request borrows one
+    authorized Http from the pool; its open TLS connection to the Gmail
+    endpoint is reused by whichever request borrows it next.
+    """
+
+    def __init__(self, credentials, size=HTTP_POOL_SIZE):
+        self.credentials = credentials
+        self.pool = queue.LifoQueue()
+        for _ in range(size):
+            self.pool.put(None)
+
+    def request(self, *args, **kwargs):
+        http = self.pool.get()
+        try:
+            if http is None:
+                import google_auth_httplib2
+                from googleapiclient.http import build_http
+                http = google_auth_httplib2.AuthorizedHttp(self.credentials, http=build_http())
+                METRICS.count('http_connections_opened')
+            response, content = http.request(*args, **kwargs)
+            METRICS.count('bytes_received', len(content or b''))
+            return response, content
+        finally:
+            self.pool.put(http)
+
+    def close(self):
+        while not self.pool.empty():
+            http = self.pool.get_nowait()
+            if http is not None:
+                http.close()
+
+
+def build_service(creds, pool_size=HTTP_POOL_SIZE):
+    """Build a Gmail service on a pooled transport from the bundled discovery document."""
+    from googleapiclient.discovery import build
+    return build(
+        'gmail', 'v1', http=PooledHttp(creds, pool_size),
+        static_discovery=True, cache_discovery=False
+    )
+
+
+def _thread_http(service):
+    """Return a transport one worker thread may use; httplib2 objects are not thread-safe."""
+    if isinstance(service._http, PooledHttp):
+        return service._http
+    import google_auth_httplib2
+    import httplib2
+    return google_auth_httplib2.AuthorizedHttp(service._http.credentials, http=httplib2.Http())
+
+
+async def _fetch_pipeline(service, ids, concurrency, body_bytes=0, bodies=None):
+    """Fetch, clean and classify messages with at most `concurrency` requests in flight."""
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    local = threading.local()
+    scheduler = scheduler_for(service)
+
+    def fetch(msg_id):
+        if not hasattr(local, 'http'):
+            local.http = _thread_http(service)
+        METRICS.count('api_calls', method='messages.get')
+        METRICS.count('http_requests', kind='single')
+        with METRICS.timer('messages.get'):
+            request = service.users().messages().get(userId='me', id=msg_id, **message_params(body_bytes))
+            try:
+                return scheduler.execute('messages.get', request, http=local.http)
+            except Exception as e:
+                # Deleted since it was listed
+                if _is_missing(e):
+                    return None
+                raise
+
+    async def process(msg_id):
+        async with semaphore:
+            txt = await loop.run_in_executor(executor, fetch, msg_id)
+        if txt is None:
+            return None
+        # Runs on the event loop while the other requests are still waiting on the network
+        return label_emails([parse_email(txt, body_bytes, bodies)])[0]
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        emails = await asyncio.gather(*(process(msg_id) for msg_id in ids))
+    return [email for email in emails if email is not None]
+
+
+def fetch_emails_concurrently(service, ids, concurrency=FETCH_CONCURRENCY, body_bytes=0, bodies=None):
+    """Fetch and classify the given messages concurrently, in the order of ids; deleted ones are left out."""
+    if not ids:
+        return []
+    return asyncio.run(_fetch_pipeline(service, ids, concurrency, body_bytes, bodies))
+
+
+def fetch_threads(service, ids, batch_size=BATCH_SIZE, body_bytes=0, bodies=None):
+    """Fetch and parse the given threads; threads deleted or entirely hidden are left out."""
+    threads = fetch_messages(service, ids, batch_size, resource='threads', missing_ok=True,
+                             **thread_params(body_bytes))
+    return [email for email in (parse_thread(t, body_bytes, bodies) for t in threads if t) if email]
+
+
+def iter_email_pages(service, max_results=None, page_size=PAGE_SIZE, batch_size=BATCH_SIZE, known=None,
+                     concurrency=None, body_bytes=0, threads=False, bodies=None):
+    """Yield pages of emails, following nextPageToken until max_results or the end of the mailbox.
+
+    Messages whose id is in `known` (a dict of id to email) are taken from
+    there instead of being fetched again. With `concurrency` set, messages are
+    fetched by the asyncio pipeline instead of batch requests. With
+    `body_bytes`, full payloads are fetched and a capped 'body' is parsed;
+    their whole bodies go into `bodies`, a BodyCache, when one is given.
+    With `threads`, the mailbox is listed by conversation and each page holds
+    one parse_thread row per thread; a known thread is only fetched again
+    when its latest snippet changed.
+    """
+    known = known or {}
+    resource = 'threads' if threads else 'messages'
+    scheduler = scheduler_for(service)
+    page_token = None
+    fetched = 0
+    while max_results is None or fetched < max_results:
+        size = page_size if max_results is None else min(page_size, max_results - fetched)
+        METRICS.count('api_calls', method=f'{resource}.list')
+        METRICS.count('http_requests', kind='single')
+        with METRICS.timer(f'{resource}.list'):
+            # A rate-limited page is retried with the same token, so the fetch resumes where it was
+            results = scheduler.execute(f'{resource}.list', getattr(service.users(), resource)().list(
+                userId='me', maxResults=size, pageToken=page_token
+            ))
+        items = results.get(resource, [])
+        ids = [item['id'] for item in items]
+        if ids:
+            missing = [item['id'] for item in items if item['id'] not in known or
+                       threads and known[item['id']]['snippet'] != clean_text(item.get('snippet', ''))]
+            METRICS.count('store_hits', len(ids) - len(missing))
+            METRICS.count('store_misses', len(missing))
+            if threads:
+                new_emails = fetch_threads(service, missing, batch_size, body_bytes, bodies)
+            elif concurrency:
+                new_emails = fetch_emails_concurrently(service, missing, concurrency, body_bytes, bodies)
+            else:
+                # A message deleted since it was listed is left out, like a deleted thread
+                messages = fetch_messages(service, missing, batch_size, missing_ok=True,
+                                          **message_params(body_bytes))
+                new_emails = [parse_email(txt, body_bytes, bodies) for txt in messages if txt]
+            fetched_emails = {email['id']: email for email in new_emails}
+            stale = set(missing)
+            yield [fetched_emails[item_id] if item_id in stale else known[item_id]
+                   for item_id in ids if item_id in fetched_emails or item_id not in stale]
+        fetched += len(ids)
+        page_token = results.get('nextPageToken')
+        if not ids or not page_token:
+            break
+
+
+def get_emails(service, max_results=10, batch_size=BATCH_SIZE, known=None, concurrency=None):
+    """Fetch emails from Gmail inbox; on an error, the emails fetched so far are returned."""
+    emails = []
+    try:
+        for page in iter_email_pages(service, max_results, batch_size=batch_size, known=known,
+                                     concurrency=concurrency):
+            emails.extend(page)
+        return emails
+
+    except Exception:
+        logger.exception("Error fetching emails")
+        return emails
+
+
+def stream_emails(service, max_results=None, page_size=PAGE_SIZE, known=None, concurrency=None,
+                  body_bytes=0, threads=False, bodies=None):
+    """Yield pages of classified emails, or conversations, as each page of the mailbox arrives."""
+    for page in iter_email_pages(service, max_results, page_size, known=known, concurrency=concurrency,
+                                 body_bytes=body_bytes, threads=threads, bodies=bodies):
+        label_emails(page)
+        yield page
+
+
+def get_history_id(service):
+    """Return the mailbox's current historyId, the starting point for the next sync."""
+    return scheduler_for(service).execute('getProfile', service.users().getProfile(userId='me'))['historyId']
+
+
+def get_history_changes(service, history_id, threads=False):
+    """Return (added ids newest first, removed ids, new historyId) since history_id.
+
+    With `threads`, the ids are those of every conversation touched since
+    history_id, to be fetched again, and none are reported removed:
+    fetch_threads leaves out the ones that are gone. Returns None when
+    history_id has expired and the caller has to fall back to a full fetch.
+    """
+    from googleapiclient.errors import HttpError
+
+    scheduler = scheduler_for(service)
+    added = {}
+    removed = set()
+    page_token = None
+    try:
+        while True:
+            METRICS.count('api_calls', method='history.list')
+            METRICS.count('http_requests', kind='single')
+            with METRICS.timer('history.list'):
+                results = scheduler.execute('history.list', service.users().history().list(
+                    userId='me', startHistoryId=history_id,
+                    historyTypes=HISTORY_TYPES, pageToken=page_token
+                ))
+            for record in results.get('history', []):
+                if threads:
+                    for kind in ('messagesAdded', 'messagesDeleted', 'labelsAdded', 'labelsRemoved'):
+                        for item in record.get(kind, []):
+                            thread_id = item['message']['threadId']
+                            added.pop(thread_id, None)
+                            added[thread_id] = True
+                    continue
+                for item in record.get('messagesAdded', []):
+                    msg = item['message']
+                    if not HIDDEN_LABELS & set(msg.get('labelIds', [])):
+                        added[msg['id']] = True
+                        removed.discard(msg['id'])
+                for item in record.get('messagesDeleted', []):
+                    added.pop(item['message']['id'], None)
+                    removed.add(item['message']['id'])
+                for item in record.get('labelsAdded', []):
+                    if HIDDEN_LABELS & set(item.get('labelIds', [])):
+                        added.pop(item['message']['id'], None)
+                        removed.add(item['message']['id'])
+                for item in record.get('labelsRemoved', []):
+                    msg = item['message']
+                    if HIDDEN_LABELS & set(item.get('labelIds', [])) and \
+                            not HIDDEN_LABELS & set(msg.get('labelIds', [])):
+                        added[msg['id']] = True
+                        removed.discard(msg['id'])
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                break
+    except HttpError as e:
+        if e.resp.status == 404:
+            return None
+        raise
+    return list(reversed(list(added))), removed, results.get('historyId', history_id)
+
+
+def fetch_new_emails(service, ids, batch_size=BATCH_SIZE, body_bytes=0, threads=False):
+    """Fetch, parse and classify the given messages, or threads, in the order of ids.
+
+    Ones deleted since the history was read are left out.
+    """
+    if not ids:
+        return []
+    if threads:
+        return label_emails(fetch_threads(service, ids, batch_size, body_bytes))
+    messages = fetch_messages(service, ids, batch_size, missing_ok=True, **message_params(body_bytes))
+    return label_emails([parse_email(txt, body_bytes) for txt in messages if txt])
+
+
+def _decode_body(data, max_bytes=None):
+    """base64url-decode a part body, touching only the input needed for max_bytes."""
+    if max_bytes is not None:
+        data = data[:-(-max_bytes // 3) * 4]
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))[:max_bytes]
+
+
+def extract_body(payload, max_bytes=None):
+    """Return the text of a message payload, preferring text/plain over text/html.
+
+    Attachments are skipped without being decoded. With max_bytes, at most
+    that many bytes of body text are decoded in total, however large the
+    message is.
+    """
+    plain = []
+    rich = []
+    parts = [payload]
+    while parts:
+        part = parts.pop()
+        body = part.get('body', {})
+        if part.get('filename') or 'attachmentId' in body:
+            continue
+        parts.extend(reversed(part.get('parts', [])))
+        if not body.get('data'):
+            continue
+        mime_type = part.get('mimeType', '')
+        if mime_type == 'text/plain':
+            plain.append(body['data'])
+        elif mime_type == 'text/html':
+            rich.append(body['data'])
+    texts = []
+    remaining = max_bytes
+    for data in plain or rich:
+        raw = _decode_body(data, remaining)
+        texts.append(raw.decode('utf-8', 'replace'))
+        if remaining is not None:
+            remaining -= len(raw)
+            if remaining <= 0:
+                break
+    text = '\n'.join(texts)
+    return clean_text(text if plain else strip_html(text))
+
+
+class BodyCache(OrderedDict):
+    """Message bodies by id, or by ('thread', id, ts), evicting the least recently used."""
+
+    def __init__(self, maxsize=BODY_CACHE_SIZE):
+        super().__init__()
+        self.maxsize = maxsize
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        if len(self) > self.maxsize:
+            self.popitem(last=False)
+
+
+def get_email_bodies(service, ids, cache, batch_size=BATCH_SIZE):
+    """Return the bodies of the given messages, downloading each one at most once."""
+    found = {msg_id: cache[msg_id] for msg_id in ids if msg_id in cache}
+    missing = [msg_id for msg_id in ids if msg_id not in found]
+    METRICS.count('body_cache_hits', len(ids) - len(missing))
+    METRICS.count('body_cache_misses', len(missing))
+    if missing:
+        messages = fetch_messages(service, missing, batch_size, format='full', fields=BODY_FIELDS)
+        for txt in messages:
+            found[txt['id']] = cache[txt['id']] = extract_body(txt.get('payload', {}))
+    return [found[msg_id] for msg_id in ids]
+
+
+def get_email_body(service, msg_id, cache):
+    """Return the body of a single message, fetching it on first use."""
+    return get_email_bodies(service, [msg_id], cache)[0]
+
+
+def get_thread_body(service, thread_id, cache, ts=None):
+    """Return the body of a conversation's latest message, fetching it once per ts."""
+    key = ('thread', thread_id, ts)
+    METRICS.count('body_cache_hits' if key in cache else 'body_cache_misses')
+    if key not in cache:
+        thread, = fetch_messages(service, [thread_id], resource='threads', format='full',
+                                 fields=THREAD_BODY_FIELDS)
+        messages = _visible_messages(thread)
+        cache[key] = extract_body(messages[-1].get('payload', {})) if messages else ''
+    return cache[key]
@@ -0,0 +1,81 @@
+"""Write categories back to Gmail as MailSort/Urgent, MailSort/Important and MailSort/Other labels."""
+import weakref
+
+from .columnar import CATEGORIES
+from .metrics import METRICS
+from .quota import scheduler_for
+
+LABEL_NAMES = {category: f'MailSort/{category}' for category in CATEGORIES}
+# messages.batchModify takes at most this many ids per call
+BATCH_MODIFY_SIZE = 1000
+
+_label_ids = weakref.WeakKeyDictionary()
+
+
+def ensure_labels(service):
+    """Return {category: label id}, creating the missing MailSort labels.
+
+    Looked up once per service: one labels.list call, plus one labels.create
+    per label that does not exist yet.
+    """
+    label_ids = _label_ids.get(service)
+    if label_ids is not None:
+        return label_ids
+    scheduler = scheduler_for(service)
+    labels = scheduler.execute('labels.list', service.users().labels().list(userId='me'))
+    existing = {label['name']: label['id'] for label in labels.get('labels', [])}
+    label_ids = {}
+    for category, name in LABEL_NAMES.items():
+        if name not in existing:
+            label = scheduler.execute('labels.create', service.users().labels().create(
+                userId='me', body={'name': name, 'labelListVisibility': 'labelShow',
+                                   'messageListVisibility': 'show'}
+            ))
+            existing[name] = label['id']
+        label_ids[category] = existing[name]
+    _label_ids[service] = label_ids
+    return label_ids
+
+
+def plan_labels(emails, label_ids):
+    """Group the emails that need relabelling by their target label id.
+
+    Returns {label id: [(message id, new 'labels' value), ...]}. Emails that
+    already carry their category's label and no other MailSort label are
+    left out.
+    """
+    ours = set(label_ids.values())
+    plan = {}
+    for email in emails:
+        target = label_ids[email['category']]
+        current = set(email.get('labels', '').split())
+        if target in current and len(current & ours) == 1:
+            continue
+        labels = ' '.join(sorted(current - ours | {target}))
+        plan.setdefault(target, []).append((email['id'], labels))
+    return plan
+
+
+def apply_labels(service, emails, chunk_size=BATCH_MODIFY_SIZE):
+    """Label messages in Gmail with their category using messages.batchModify.
+
+    emails are message rows with 'category' and, from the fetch, the user
+    labels they carry under 'labels'. Returns {message id: new labels} for
+    the messages that were changed.
+    """
+    label_ids = ensure_labels(service)
+    scheduler = scheduler_for(service)
+    changed = {}
+    for target, updates in plan_labels(emails, label_ids).items():
+        remove = [label_id for label_id in label_ids.values() if label_id != target]
+        for start in range(0, len(updates), chunk_size):
+            chunk = updates[start:start + chunk_size]
+            request = service.users().messages().batchModify(userId='me', body={
+                'ids': [msg_id for msg_id, _ in chunk], 'addLabelIds': [target], 'removeLabelIds': remove
+            })
+            with METRICS.timer('messages.batchModify'):
+                scheduler.execute('messages.batchModify', request)
+            METRICS.count('api_calls', method='messages.batchModify')
+            METRICS.count('http_requests', kind='single')
+            changed.update(chunk)
+    return changed
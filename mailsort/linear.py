@@ -0,0 +1,217 @@
+"""Hashed n-gram linear classifier, scored a whole batch at a time with NumPy.
+
+An optional alternative to the rule cascade in classify.py. Subject, sender
+and snippet are split into words; words and adjacent word pairs are hashed
+into a fixed-size feature space, and each batch is scored with one gather
+of the Urgent / Important / Other weight rows plus a per-record bincount. The
+model is trained offline from rule-labelled mail:
+
+    python -m mailsort.linear --store mailsort.db archive.mbox -o mailsort-model.npz
+
+NumPy is only needed when this module is used.
+"""
+import argparse
+import hashlib
+import sys
+import zlib
+
+from .classify import classify_many
+from .columnar import CATEGORIES
+from .metrics import METRICS
+
+MODEL_PATH = 'mailsort-model.npz'
+N_FEATURES = 1 << 18
+FIELDS = ('subject', 'sender', 'snippet')
+TRAIN_EPOCHS = 10
+TRAIN_BATCH_SIZE = 256
+LEARNING_RATE = 5.0
+L2 = 1e-6
+# Word hashes are memoised; the vocabulary of a mailbox is small next to its word count
+HASH_MEMO_SIZE = 1 << 20
+_BIGRAM_MIX = 0x9E3779B1
+
+# One translate pass lower-cases ASCII letters and turns punctuation into spaces;
+# bytes of multi-byte UTF-8 characters are kept as word characters.
+_TOKEN_TABLE = bytes(
+    c + 32 if 65 <= c <= 90 else c if 48 <= c <= 57 or 97 <= c <= 122 or c >= 128 else 32
+    for c in range(256)
+)
+# 0xff never occurs in UTF-8, so it cannot collide with a real word
+_SEPARATOR = b' \xff '
+_memo = [{} for _ in FIELDS]
+
+
+def _word_ids(field, words):
+    """Map words to feature ids, with -1 for record separators."""
+    memo = _memo[field]
+    try:
+        return list(map(memo.__getitem__, words))
+    except KeyError:
+        if len(memo) >= HASH_MEMO_SIZE:
+            memo.clear()
+        memo[_SEPARATOR.strip()] = -1
+        for word in words:
+            if word not in memo:
+                memo[word] = zlib.crc32(word, field + 1) & (N_FEATURES - 1)
+        return list(map(memo.__getitem__, words))
+
+
+def featurize(records):
+    """Hash (snippet, sender, subject) records into feature ids.
+
+    Returns (features, docs): parallel arrays of feature ids and the index
+    of the record each feature belongs to. Each field of the whole batch is
+    tokenized in one pass.
+    """
+    import numpy as np
+
+    features, docs = [], []
+    for field, texts in enumerate(zip(*records)):
+        data = _SEPARATOR.join((text or '').encode('utf-8', 'replace') for text in texts)
+        ids = np.array(_word_ids(field, data.translate(_TOKEN_TABLE).split()), dtype=np.int64)
+        is_word = ids >= 0
+        doc = np.cumsum(~is_word)
+        features.append(ids[is_word])
+        docs.append(doc[is_word])
+        # Adjacent words of the same record also count as a pair
+        pair = is_word[:-1] & is_word[1:]
+        features.append(((ids[:-1][pair] * _BIGRAM_MIX) ^ ids[1:][pair]) & (N_FEATURES - 1))
+        docs.append(doc[:-1][pair])
+    if not features:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    # Presence, not counts, like the keyword rules: a long repetitive mail must not outvote its subject
+    keys = np.concatenate(docs) * N_FEATURES + np.concatenate(features)
+    keys.sort()
+    first = np.ones(len(keys), dtype=bool)
+    first[1:] = keys[1:] != keys[:-1]
+    keys = keys[first]
+    return keys % N_FEATURES, keys // N_FEATURES
+
+
+def _doc_sums(values, docs, n_docs):
+    """Sum the rows of values per record: one bincount per category column."""
+    import numpy as np
+
+    return np.stack(
+        [np.bincount(docs, weights=values[:, k], minlength=n_docs) for k in range(values.shape[1])],
+        axis=1
+    )
+
+
+class LinearModel:
+    """Per-category weights over hashed word and word-pair features."""
+
+    def __init__(self, weights=None, bias=None):
+        import numpy as np
+
+        if weights is None:
+            weights = np.zeros((N_FEATURES, len(CATEGORIES)), dtype=np.float32)
+            bias = np.zeros(len(CATEGORIES))
+        self.weights = weights
+        self.bias = bias
+        digest = hashlib.sha1(weights.tobytes())
+        digest.update(bias.tobytes())
+        # Stored alongside categories in place of the ruleset version
+        self.version = 'linear-' + digest.hexdigest()[:12]
+
+    def scores(self, records):
+        """Return an (n, categories) array of scores for a list of records."""
+        features, docs = featurize(records)
+        return _doc_sums(self.weights[features], docs, len(records)) + self.bias
+
+    def classify_many(self, records):
+        """Classify (snippet, sender, subject) records, returning the categories in order."""
+        records = list(records)
+        METRICS.count('classified', len(records))
+        if not records:
+            return []
+        with METRICS.timer('classify_linear'):
+            best = self.scores(records).argmax(axis=1)
+        return [CATEGORIES[code] for code in best.tolist()]
+
+    def save(self, path=MODEL_PATH):
+        import numpy as np
+
+        np.savez_compressed(path, weights=self.weights, bias=self.bias)
+
+    @classmethod
+    def load(cls, path=MODEL_PATH):
+        import numpy as np
+
+        with np.load(path, allow_pickle=False) as data:
+            weights, bias = data['weights'], data['bias']
+        if weights.shape != (N_FEATURES, len(CATEGORIES)):
+            raise ValueError(f"{path} was trained for a different feature space")
+        return cls(weights, bias)
+
+
+def train(records, labels=None, epochs=TRAIN_EPOCHS, batch_size=TRAIN_BATCH_SIZE,
+          learning_rate=LEARNING_RATE, seed=0):
+    """Fit a LinearModel by minibatch softmax regression.
+
+    Without labels, the rule-based classifier labels the records, so the model
+    starts out agreeing with the rules and can then be retrained on corrections.
+    """
+    import numpy as np
+
+    records = list(records)
+    if labels is None:
+        labels = classify_many(records)
+    codes = {name: code for code, name in enumerate(CATEGORIES)}
+    targets = np.eye(len(CATEGORIES))[[codes[label] for label in labels]]
+    weights = np.zeros((N_FEATURES, len(CATEGORIES)))
+    bias = np.zeros(len(CATEGORIES))
+    rng = np.random.default_rng(seed)
+    for _ in range(epochs):
+        order = rng.permutation(len(records))
+        for start in range(0, len(records), batch_size):
+            batch = order[start:start + batch_size]
+            features, docs = featurize([records[i] for i in batch])
+            logits = _doc_sums(weights[features], docs, len(batch)) + bias
+            logits -= logits.max(axis=1, keepdims=True)
+            probs = np.exp(logits)
+            probs /= probs.sum(axis=1, keepdims=True)
+            # Mean over the batch, so the step size does not grow with batch_size
+            error = (probs - targets[batch]) / len(batch)
+            touched = np.unique(features)
+            for k in range(len(CATEGORIES)):
+                grad = np.bincount(features, weights=error[docs, k], minlength=N_FEATURES)
+                weights[touched, k] -= learning_rate * (grad[touched] + L2 * weights[touched, k])
+            bias -= learning_rate * error.sum(axis=0)
+    return LinearModel(weights.astype(np.float32), bias)
+
+
+def main(argv=None):
+    from .archive import iter_archive, parse_message
+    from .store import load_emails, open_store
+
+    parser = argparse.ArgumentParser(
+        prog='python -m mailsort.linear',
+        description='Train the linear classifier from rule-labelled mail.'
+    )
+    parser.add_argument('archives', nargs='*', help='mbox files, Maildir directories or .eml files')
+    parser.add_argument('--store', help='also train on the emails in this MailSort store')
+    parser.add_argument('-o', '--output', default=MODEL_PATH, help=f'model file (default {MODEL_PATH})')
+    parser.add_argument('--epochs', type=int, default=TRAIN_EPOCHS,
+                        help=f'passes over the data (default {TRAIN_EPOCHS})')
+    args = parser.parse_args(argv)
+    if not args.archives and not args.store:
+        parser.error("give at least one archive or --store")
+
+    emails = load_emails(open_store(args.store)) if args.store else []
+    for path in args.archives:
+        emails.extend(parse_message(key, data) for key, data in iter_archive(path))
+    records = [(email['snippet'], email['sender'], email['subject']) for email in emails]
+    # Hold out every tenth email to report how closely the model follows the rules
+    held_out, training = records[::10], [r for i, r in enumerate(records) if i % 10]
+    model = train(training, epochs=args.epochs)
+    model.save(args.output)
+    agreement = sum(map(str.__eq__, model.classify_many(held_out), classify_many(held_out)))
+    print(f"Trained on {len(training)} emails; agrees with the rules on "
+          f"{agreement / max(len(held_out), 1):.1%} of {len(held_out)} held-out emails",
+          file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,117 @@
+"""Lightweight stage timers and counters for the MailSort hot paths."""
+from collections import defaultdict
+import json
+import threading
+import time
+
+
+class _StageTimer:
+    __slots__ = ('metrics', 'stage', 'started')
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.stage, time.perf_counter() - self.started)
+        return False
+
+
+class _NoTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_TIMER = _NoTimer()
+
+
+class Metrics:
+    """Stage timers and counters for the fetch, classify and render hot paths.
+
+    Disabled by default; while disabled, timer() hands back a shared no-op
+    context manager and observe() and count() return immediately.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = defaultdict(float)
+            self.stages = defaultdict(lambda: [0, 0.0, 0.0])
+
+    def timer(self, stage):
+        return _StageTimer(self, stage) if self.enabled else _NO_TIMER
+
+    def observe(self, stage, seconds):
+        if not self.enabled:
+            return
+        with self.lock:
+            entry = self.stages[stage]
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] = max(entry[2], seconds)
+
+    def count(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] += value
+
+    def hit_rate(self, name):
+        """Hit rate of a cache counted as `<name>_hits` and `<name>_misses`."""
+        hits = sum(v for (n, _), v in self.counters.items() if n == f'{name}_hits')
+        misses = sum(v for (n, _), v in self.counters.items() if n == f'{name}_misses')
+        return hits / (hits + misses) if hits + misses else None
+
+    def snapshot(self):
+        with self.lock:
+            stages = {stage: list(entry) for stage, entry in self.stages.items()}
+            counters = dict(self.counters)
+        return stages, counters
+
+    def to_jsonl(self):
+        """Export the current values as JSON lines, one metric per line."""
+        stages, counters = self.snapshot()
+        now = time.time()
+        lines = []
+        for stage, (calls, total, slowest) in sorted(stages.items()):
+            lines.append(json.dumps({
+                'ts': now, 'metric': 'stage', 'stage': stage,
+                'calls': calls, 'seconds': total, 'max_seconds': slowest
+            }))
+        for (name, labels), value in sorted(counters.items()):
+            lines.append(json.dumps({'ts': now, 'metric': name, **dict(labels), 'value': value}))
+        return '\n'.join(lines) + '\n'
+
+    def to_prometheus(self):
+        """Export the current values in the Prometheus text exposition format."""
+        stages, counters = self.snapshot()
+        lines = ['# TYPE mailsort_stage_seconds summary']
+        for stage, (calls, total, _) in sorted(stages.items()):
+            lines.append(f'mailsort_stage_seconds_count{{stage="{stage}"}} {calls}')
+            lines.append(f'mailsort_stage_seconds_sum{{stage="{stage}"}} {total:.6f}')
+        declared = set()
+        for (name, labels), value in sorted(counters.items()):
+            metric = f'mailsort_{name}_total'
+            if metric not in declared:
+                lines.append(f'# TYPE {metric} counter')
+                declared.add(metric)
+            label_text = ','.join(f'{k}="{v}"' for k, v in labels)
+            lines.append(f'{metric}{{{label_text}}} {value:g}' if label_text else f'{metric} {value:g}')
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics()
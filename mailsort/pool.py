@@ -0,0 +1,37 @@
+"""Process pools that are safe to start from the threaded dashboard server.
+
+Workers are spawned, not forked, so they do not inherit the server's
+threads and held locks. A spawned child normally re-runs the parent's
+__main__ script first; under Streamlit that is the whole dashboard, which
+opens the store and classifies it again. Workers here only run functions
+from the mailsort package, so they are started with an empty __main__.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing.context
+import sys
+import threading
+import types
+
+_MAIN_STUB = types.ModuleType('__main__')
+_main_lock = threading.Lock()
+
+
+class _SpawnProcess(multiprocessing.context.SpawnProcess):
+    def start(self):
+        # Spawn reads the child's __main__ from sys.modules while starting it
+        with _main_lock:
+            main = sys.modules['__main__']
+            sys.modules['__main__'] = _MAIN_STUB
+            try:
+                super().start()
+            finally:
+                sys.modules['__main__'] = main
+
+
+class _SpawnContext(multiprocessing.context.SpawnContext):
+    Process = _SpawnProcess
+
+
+def process_pool(max_workers=None):
+    """Return a ProcessPoolExecutor whose workers are spawned without re-running __main__."""
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=_SpawnContext())
@@ -0,0 +1,176 @@
+"""Gmail quota pacing: token buckets per user and per project, and adaptive backoff.
+
+Every Gmail method costs a fixed number of quota units. Requests wait for
+their units in the account's bucket and in the project-wide bucket before
+they are sent, so a long fetch runs at the sustained quota instead of
+bursting into 429s. When Gmail still answers with a rate-limit error or a
+5xx, the request is retried after a jittered exponential backoff, and the
+account's rate is halved and then recovers step by step.
+
+The project bucket only covers one process. Worker processes that share
+the project, like the multi-account fetch, each take their share of it
+with set_project_rate.
+"""
+import random
+import threading
+import time
+import weakref
+
+from .metrics import METRICS
+
+# Quota units per call, from the Gmail API usage limits
+QUOTA_UNITS = {
+    'messages.list': 5,
+    'messages.get': 5,
+    'messages.batchModify': 50,
+    'threads.list': 10,
+    'threads.get': 10,
+    'history.list': 2,
+    'getProfile': 1,
+    'labels.list': 1,
+    'labels.create': 5,
+}
+DEFAULT_UNITS = 5
+# Per-user limit, in units per second
+USER_RATE = 250
+# Per-project limit: 1,200,000 units per minute
+PROJECT_RATE = 20000
+# Never slow an account below this many units per second
+MIN_RATE = 10
+# Units per second an account regains for each call that succeeds
+RATE_RECOVERY = 1
+MAX_RETRIES = 5
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 32
+
+
+class TokenBucket:
+    """Thread-safe token bucket refilled at `rate` units per second up to `capacity`."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, units):
+        """Take units from the bucket, sleeping until they are available; returns the seconds waited."""
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            # Going into debt reserves the units, so waiters queue up instead of racing
+            self.tokens -= units
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+PROJECT_BUCKET = TokenBucket(PROJECT_RATE)
+
+
+def set_project_rate(rate):
+    """Pace this process to rate units per second of the project quota, e.g. its share among worker processes."""
+    with PROJECT_BUCKET.lock:
+        PROJECT_BUCKET.rate = PROJECT_BUCKET.capacity = rate
+        PROJECT_BUCKET.tokens = min(PROJECT_BUCKET.tokens, rate)
+
+
+def units_for(method, count=1):
+    return QUOTA_UNITS.get(method, DEFAULT_UNITS) * count
+
+
+def is_retryable(error):
+    """Whether error is a rate-limit answer or a server error worth retrying."""
+    status = getattr(getattr(error, 'resp', None), 'status', None)
+    if status is None:
+        return False
+    status = int(status)
+    if status == 429 or status >= 500:
+        return True
+    content = getattr(error, 'content', b'') or b''
+    if isinstance(content, str):
+        content = content.encode()
+    # userRateLimitExceeded and rateLimitExceeded come back as 403
+    return status == 403 and b'ratelimitexceeded' in content.lower()
+
+
+def backoff_delay(attempt):
+    """Full-jitter exponential backoff for the given retry attempt, counted from 0."""
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+class QuotaScheduler:
+    """Paces one account's Gmail requests to the per-user and per-project quotas.
+
+    The project bucket is shared by every scheduler in the process; see
+    set_project_rate for processes that share the project. On a
+    rate-limit error the account's rate is halved, down to MIN_RATE, and it
+    grows back by RATE_RECOVERY units per second for each call that succeeds.
+    """
+
+    def __init__(self, rate=USER_RATE, project=PROJECT_BUCKET, retries=MAX_RETRIES):
+        self.max_rate = rate
+        self.user = TokenBucket(rate)
+        self.project = project
+        self.retries = retries
+
+    def acquire(self, method, count=1):
+        """Wait until count calls of method fit in the quota."""
+        units = units_for(method, count)
+        waited = self.project.acquire(units) + self.user.acquire(units)
+        METRICS.count('quota_units', units, method=method)
+        if waited:
+            METRICS.observe('quota_wait', waited)
+
+    def succeeded(self, count=1):
+        bucket = self.user
+        if bucket.rate < self.max_rate:
+            with bucket.lock:
+                bucket.rate = min(self.max_rate, bucket.rate + RATE_RECOVERY * count)
+
+    def throttled(self, attempt):
+        """Slow the account down after a rate-limit error and wait out the backoff."""
+        bucket = self.user
+        with bucket.lock:
+            bucket.rate = max(MIN_RATE, bucket.rate / 2)
+        METRICS.count('quota_backoffs')
+        time.sleep(backoff_delay(attempt))
+
+    def execute(self, method, request, count=1, **kwargs):
+        """Execute request (or a batch of count calls) within quota, retrying rate limits and 5xx."""
+        for attempt in range(self.retries + 1):
+            self.acquire(method, count)
+            try:
+                response = request.execute(**kwargs)
+            except Exception as e:
+                if attempt == self.retries or not is_retryable(e):
+                    raise
+                self.throttled(attempt)
+            else:
+                self.succeeded(count)
+                return response
+
+
+_schedulers = weakref.WeakKeyDictionary()
+_schedulers_lock = threading.Lock()
+
+
+def scheduler_for(service):
+    """Return the QuotaScheduler of a Gmail service; one service is built per account."""
+    with _schedulers_lock:
+        scheduler = _schedulers.get(service)
+        if scheduler is None:
+            scheduler = _schedulers[service] = QuotaScheduler()
+        return scheduler
+
+
+def set_scheduler(service, scheduler):
+    """Use scheduler for service's requests, e.g. one with a lower rate for a shared account."""
+    with _schedulers_lock:
+        _schedulers[service] = scheduler
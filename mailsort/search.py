@@ -0,0 +1,104 @@
+"""In-process inverted index over subject, sender and snippet."""
+from bisect import bisect_left
+import re
+
+_TOKEN = re.compile(r'\w+')
+PREFIX_FILTER_LIMIT = 2000
+
+
+def tokenize(text):
+    return _TOKEN.findall(text.lower())
+
+
+class SearchIndex:
+    """Inverted index from lower-cased word tokens to message ids.
+
+    Messages are added and removed incrementally; a row whose 'ts' changed,
+    such as a conversation with a new reply, is indexed again. Queries are
+    AND-ed terms; the last term, and any term ending in '*', matches as a
+    prefix.
+    """
+
+    def __init__(self):
+        self.postings = {}
+        self.doc_tokens = {}
+        self.doc_ts = {}
+        self.vocabulary = []
+        self.vocabulary_dirty = False
+
+    def __len__(self):
+        return len(self.doc_tokens)
+
+    def add(self, emails):
+        """Index emails whose id is not indexed yet, or was indexed at another ts."""
+        for email in emails:
+            msg_id = email['id']
+            if msg_id in self.doc_tokens:
+                if self.doc_ts[msg_id] == email.get('ts'):
+                    continue
+                self.remove([msg_id])
+            self.doc_ts[msg_id] = email.get('ts')
+            tokens = frozenset(tokenize(f"{email['subject']} {email['sender']} {email['snippet']}"))
+            self.doc_tokens[msg_id] = tokens
+            for token in tokens:
+                ids = self.postings.get(token)
+                if ids is None:
+                    self.postings[token] = {msg_id}
+                    self.vocabulary_dirty = True
+                else:
+                    ids.add(msg_id)
+
+    def remove(self, ids):
+        """Drop the given message ids from the index."""
+        for msg_id in ids:
+            self.doc_ts.pop(msg_id, None)
+            for token in self.doc_tokens.pop(msg_id, ()):
+                postings = self.postings[token]
+                postings.discard(msg_id)
+                if not postings:
+                    del self.postings[token]
+                    self.vocabulary_dirty = True
+
+    def sync(self, emails):
+        """Make the index cover exactly the given emails."""
+        current = {email['id']: email.get('ts') for email in emails}
+        self.remove([msg_id for msg_id in self.doc_tokens if msg_id not in current])
+        if len(self.doc_tokens) < len(current) or current != self.doc_ts:
+            self.add(emails)
+
+    def _prefix_matches(self, prefix):
+        if self.vocabulary_dirty:
+            self.vocabulary = sorted(self.postings)
+            self.vocabulary_dirty = False
+        start = bisect_left(self.vocabulary, prefix)
+        ids = set()
+        for token in self.vocabulary[start:]:
+            if not token.startswith(prefix):
+                break
+            ids |= self.postings[token]
+        return ids
+
+    def search(self, query):
+        """Return the set of message ids matching every term of query."""
+        terms = []
+        raw_terms = query.split()
+        for i, raw in enumerate(raw_terms):
+            tokens = tokenize(raw)
+            prefix = raw.endswith('*') or i == len(raw_terms) - 1
+            terms.extend((token, prefix and j == len(tokens) - 1) for j, token in enumerate(tokens))
+        # Exact terms first: each is one dict lookup and they narrow the result the most
+        terms.sort(key=lambda term: term[1])
+        result = None
+        for token, prefix in terms:
+            if not prefix:
+                ids = self.postings.get(token, set())
+            elif result is not None and len(result) <= PREFIX_FILTER_LIMIT:
+                # Cheaper to check the few remaining documents than to expand the prefix
+                ids = {msg_id for msg_id in result
+                       if any(t.startswith(token) for t in self.doc_tokens[msg_id])}
+            else:
+                ids = self._prefix_matches(token)
+            result = set(ids) if result is None else result & ids
+            if not result:
+                return set()
+        return result if result is not None else set()
@@ -0,0 +1,88 @@
+"""Local SQLite store of fetched messages, their categories and sync state."""
+import sqlite3
+
+STORE_PATH = 'mailsort.db'
+STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id TEXT PRIMARY KEY,
+    sender TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    snippet TEXT NOT NULL,
+    date TEXT NOT NULL,
+    ts INTEGER NOT NULL,
+    category TEXT,
+    ruleset TEXT,
+    thread_size INTEGER,
+    labels TEXT
+);
+CREATE INDEX IF NOT EXISTS messages_ts ON messages (ts DESC);
+CREATE INDEX IF NOT EXISTS messages_category ON messages (category);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def open_store(path=STORE_PATH):
+    """Open the local message store, creating it in WAL mode on first use."""
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.executescript(STORE_SCHEMA)
+    columns = {row['name'] for row in conn.execute('PRAGMA table_info(messages)')}
+    if 'ruleset' not in columns:
+        conn.execute('ALTER TABLE messages ADD COLUMN ruleset TEXT')
+    if 'thread_size' not in columns:
+        conn.execute('ALTER TABLE messages ADD COLUMN thread_size INTEGER')
+    if 'labels' not in columns:
+        conn.execute('ALTER TABLE messages ADD COLUMN labels TEXT')
+    return conn
+
+
+def load_emails(conn):
+    """Return all stored emails, newest first."""
+    rows = conn.execute(
+        'SELECT id, sender, subject, snippet, date, ts, category, ruleset, thread_size, labels FROM messages '
+        'ORDER BY ts DESC'
+    )
+    return [{k: row[k] for k in row.keys() if row[k] is not None} for row in rows]
+
+
+def save_emails(conn, emails):
+    """Insert or update emails, or conversation rows, and their categories in the store."""
+    with conn:
+        conn.executemany(
+            'INSERT OR REPLACE INTO messages '
+            '(id, sender, subject, snippet, date, ts, category, ruleset, thread_size, labels) '
+            'VALUES (:id, :sender, :subject, :snippet, :date, :ts, :category, :ruleset, :thread_size, '
+            ':labels)',
+            [{'ts': 0, 'category': None, 'ruleset': None, 'thread_size': None, 'labels': None, **email}
+             for email in emails]
+        )
+
+
+def delete_emails(conn, ids):
+    """Remove the given message ids from the store."""
+    with conn:
+        conn.executemany('DELETE FROM messages WHERE id = ?', [(msg_id,) for msg_id in ids])
+
+
+def prune_emails(conn, keep_ids):
+    """Remove every stored message whose id is not in keep_ids."""
+    keep_ids = set(keep_ids)
+    stale = [row['id'] for row in conn.execute('SELECT id FROM messages') if row['id'] not in keep_ids]
+    delete_emails(conn, stale)
+
+
+def get_meta(conn, key, default=None):
+    """Read a value such as the last synced historyId from the store."""
+    row = conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+    return row['value'] if row else default
+
+
+def set_meta(conn, key, value):
+    """Write a value to the store's metadata table."""
+    with conn:
+        conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
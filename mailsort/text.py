@@ -0,0 +1,37 @@
+"""Text normalisation and header extraction shared by the dashboard and offline tools."""
+import html
+import re
+
+
+def clean_text(text):
+    """Remove invalid or non-displayable characters and decode HTML entities."""
+    if not text:
+        return ""
+    text = html.unescape(text)
+    text = re.sub(r'[\x00-\x08\x0b-\x0c\x0e-\x1f\x7f-\x9f]', '', text)
+    return text.strip()
+
+
+# A block the byte cap cut off before its closing tag runs to the end of the text
+_HTML_BLOCKS = re.compile(r'<(script|style|head)\b.*?(?:</\1\s*>|\Z)', re.IGNORECASE | re.DOTALL)
+# A body cut off mid-tag leaves an unterminated tag at the end
+_HTML_TAGS = re.compile(r'<[^>]*(?:>|$)')
+
+
+def strip_html(text):
+    """Cheaply turn HTML into text: drop script, style and head blocks, then every tag."""
+    return _HTML_TAGS.sub(' ', _HTML_BLOCKS.sub(' ', text))
+
+
+def extract_headers(headers):
+    """Return (subject, sender, date) from an iterable of (name, value) header pairs."""
+    subject = sender = date = ""
+    for name, value in headers:
+        n = (name or '').lower()
+        if n == 'subject':
+            subject = value or ''
+        elif n == 'from':
+            sender = value or ''
+        elif n == 'date':
+            date = value or ''
+    return subject, sender, date
@@ -0,0 +1,175 @@
+"""Background polling that keeps an account's local mailbox warm."""
+from collections import namedtuple
+from itertools import chain
+import logging
+import threading
+
+from .columnar import EmailColumns
+from .gmail import fetch_new_emails, get_history_changes
+from .metrics import METRICS
+from .store import STORE_PATH, delete_emails, open_store, save_emails, set_meta
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = 60
+MAX_BACKLOG = 500
+
+Snapshot = namedtuple('Snapshot', 'version emails history_id error threads')
+# How a worker polls, fixed from one start or restart to the next
+Settings = namedtuple(
+    'Settings', 'poll_interval max_backlog classifier body_bytes threads',
+    defaults=(POLL_INTERVAL, MAX_BACKLOG, None, 0, False)
+)
+
+
+class MailboxWorker:
+    """Poll one account for changes in a daemon thread and publish snapshots.
+
+    A snapshot's EmailColumns is never modified once published, so readers
+    take it by reference instead of copying the mailbox. The Settings given
+    to start or restart hold until the next restart: at most max_backlog new
+    messages are fetched per poll, the rest following on the next polls
+    without waiting for the interval; classifier is a ClassificationCache
+    whose categories are published instead of the rule-based ones;
+    body_bytes classifies new mail by its body too; and threads keeps the
+    mailbox as one row per conversation.
+    """
+
+    def __init__(self, service, store_path=STORE_PATH):
+        self.service = service
+        self.store_path = store_path
+        self.settings = Settings()
+        self.snapshot = Snapshot(0, EmailColumns(), None, None, False)
+        self.backlog = []
+        self.pending_history_id = None
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive() and not self.stopping.is_set()
+
+    def start(self, emails, history_id, settings=Settings()):
+        """Start polling from the given mailbox state, or poll now if already running with these settings."""
+        with self.lock:
+            if self.running and settings == self.settings:
+                self.wakeup.set()
+                return
+            self._restart(emails, history_id, settings)
+
+    def restart(self, emails, history_id, settings=Settings()):
+        """Poll from a newer mailbox state, such as a full resync, instead of the current one.
+
+        The poll in flight, if any, is abandoned rather than waited for.
+        """
+        with self.lock:
+            self._restart(emails, history_id, settings)
+
+    def stop(self, timeout=0):
+        """Stop polling; the poll in flight is abandoned. Waits up to timeout seconds for it."""
+        with self.lock:
+            self.stopping.set()
+            self.wakeup.set()
+            thread = self.thread
+        if thread is not None and timeout:
+            thread.join(timeout)
+
+    def _restart(self, emails, history_id, settings):
+        # Caller holds self.lock. Each thread gets its own stop event, so an
+        # abandoned poll can finish in the background without touching the new state.
+        self.stopping.set()
+        self.wakeup.set()
+        self.settings = settings
+        self.backlog = []
+        self.stopping = threading.Event()
+        self.wakeup = threading.Event()
+        self._publish(emails, history_id)
+        self.thread = threading.Thread(
+            target=self._run, args=(self.stopping, self.wakeup), name='mailsort-poll', daemon=True
+        )
+        self.thread.start()
+
+    def _publish(self, emails, history_id, error=None):
+        self.snapshot = Snapshot(self.snapshot.version + 1, emails, history_id, error, self.settings.threads)
+
+    def _run(self, stopping, wakeup):
+        conn = open_store(self.store_path)
+        try:
+            while not stopping.is_set():
+                try:
+                    if not self.poll(conn, stopping):
+                        return
+                except Exception as e:
+                    logger.exception("Background poll failed")
+                    with self.lock:
+                        if stopping.is_set():
+                            return
+                        snapshot = self.snapshot
+                        self._publish(snapshot.emails, snapshot.history_id, str(e))
+                if not self.backlog:
+                    wakeup.wait(self.settings.poll_interval)
+                wakeup.clear()
+        finally:
+            conn.close()
+
+    def poll(self, conn, stopping=None):
+        """Apply one round of mailbox changes; returns False when a full fetch is needed.
+
+        Once stopping is set, the results of the round are dropped.
+        """
+        stopping = stopping or threading.Event()
+        settings = self.settings
+        snapshot = self.snapshot
+        emails = snapshot.emails
+        threads = settings.threads
+        removed = set()
+        if not self.backlog:
+            with METRICS.timer('poll'):
+                changes = get_history_changes(self.service, snapshot.history_id, threads)
+            # State shared with start() and restart() only changes under the lock, and not once abandoned
+            with self.lock:
+                if stopping.is_set():
+                    return False
+                if changes is None:
+                    self._publish(emails, None, "Mailbox history expired; fetch again to reload it")
+                    return False
+                added, removed, self.pending_history_id = changes
+                known = set(emails.ids)
+                # Touched conversations are fetched again, known or not
+                self.backlog = added if threads else [msg_id for msg_id in added if msg_id not in known]
+                removed &= known
+
+        with self.lock:
+            if stopping.is_set():
+                return False
+            batch, self.backlog = self.backlog[:settings.max_backlog], self.backlog[settings.max_backlog:]
+        new_emails = fetch_new_emails(self.service, batch, body_bytes=settings.body_bytes, threads=threads)
+        if threads:
+            # A touched thread that did not come back was deleted or moved to spam or trash
+            removed = set(batch) - {email['id'] for email in new_emails}
+            removed &= set(emails.ids)
+        if new_emails or removed:
+            replaced = removed.union(email['id'] for email in new_emails)
+            kept = (email for email in emails if email['id'] not in replaced)
+            rows = sorted(chain(new_emails, kept), key=lambda email: email.get('ts', 0), reverse=True)
+            classifier = settings.classifier
+            if classifier is None:
+                emails = EmailColumns(rows, [email['category'] for email in rows])
+            else:
+                emails = EmailColumns(rows, classifier.classify(rows), classifier.version)
+        with self.lock:
+            if stopping.is_set():
+                return False
+            if new_emails or removed:
+                save_emails(conn, new_emails)
+                delete_emails(conn, removed)
+            # The stored history only moves on once the whole backlog is in
+            history_id = snapshot.history_id
+            if not self.backlog and self.pending_history_id != history_id:
+                history_id = self.pending_history_id
+                set_meta(conn, 'history_id', history_id)
+            if emails is not snapshot.emails or history_id != snapshot.history_id or snapshot.error:
+                self._publish(emails, history_id)
+        return True
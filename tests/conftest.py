@@ -0,0 +1,94 @@
+import os
+import sys
+import types
+
+import pytest
+
+from mailsort import quota
+from mailsort.quota import QuotaScheduler, TokenBucket, set_scheduler
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+from bench_mailsort import FakeBatch, FakeGmailService, FakeRequest, make_corpus  # noqa: E402
+
+
+class HttpError(Exception):
+    """Stand-in for googleapiclient's HttpError: an answer's status and body."""
+
+    def __init__(self, status, content=b''):
+        super().__init__(status)
+        self.resp = types.SimpleNamespace(status=status)
+        self.content = content
+
+
+class RecordingBatch(FakeBatch):
+    """FakeBatch that logs the ids it sends and hands sub-request errors to the callback."""
+
+    def __init__(self, service, callback):
+        super().__init__(callback)
+        self.service = service
+
+    def execute(self, http=None):
+        self.service.batches.append([request_id for request_id, _ in self.requests])
+        for request_id, request in self.requests:
+            try:
+                response = request.execute()
+            except HttpError as e:
+                self.callback(request_id, None, e)
+            else:
+                self.callback(request_id, response, None)
+
+
+class FakeHistory:
+    def __init__(self, service):
+        self.service = service
+
+    def list(self, userId='me', startHistoryId=None, historyTypes=None, pageToken=None):
+        def run():
+            if self.service.history_error is not None:
+                raise self.service.history_error
+            return {'history': self.service.history_records, 'historyId': self.service.history_id}
+        return FakeRequest(run)
+
+
+class GmailFake(FakeGmailService):
+    """FakeGmailService with failing gets, a log of the batches sent and a change history.
+
+    failures maps a message id to the statuses its next gets fail with; ids
+    not in the mailbox answer 404. Requests are not paced to the quota.
+    """
+
+    def __init__(self, n=0, seed=0):
+        super().__init__(make_corpus('short', n, seed))
+        self.failures = {}
+        self.batches = []
+        self.history_records = []
+        self.history_id = '200'
+        self.history_error = None
+        set_scheduler(self, QuotaScheduler(1e12, TokenBucket(1e12)))
+
+    def new_batch_http_request(self, callback=None):
+        return RecordingBatch(self, callback)
+
+    def get(self, userId='me', id=None, **kwargs):
+        def run():
+            failures = self.failures.get(id)
+            if failures:
+                raise HttpError(failures.pop(0))
+            if id not in self.messages_by_id:
+                raise HttpError(404)
+            return self.messages_by_id[id]
+        return FakeRequest(run)
+
+    def history(self):
+        return FakeHistory(self)
+
+
+@pytest.fixture
+def gmail():
+    return GmailFake(30)
+
+
+@pytest.fixture
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(quota, 'backoff_delay', lambda attempt: 0)
@@ -0,0 +1,50 @@
+import random
+import sys
+import types
+
+from mailsort.classify import (
+    KEYWORD_GROUPS, KEYWORD_MATCHER, PARALLEL_THRESHOLD, classify_email, classify_many, match_counts
+)
+
+
+def test_classify_many_pool_does_not_rerun_a_streamlit_main(tmp_path, monkeypatch):
+    # Streamlit runs the dashboard as a __main__ with a __file__ and no __spec__
+    marker = tmp_path / 'ran'
+    script = tmp_path / 'dashboard.py'
+    script.write_text(f'open({str(marker)!r}, "w").close()\n')
+    main = types.ModuleType('__main__')
+    main.__file__ = str(script)
+    main.__spec__ = None
+    monkeypatch.setitem(sys.modules, '__main__', main)
+
+    records = [('Please review the attached', 'it@example.com', f'Action required {i}') if i % 2 else
+               ('50% off everything', 'deals@shop.example', f'Sale {i}') for i in range(PARALLEL_THRESHOLD)]
+    assert classify_many(records, processes=2) == [classify_email(*record) for record in records]
+    assert not marker.exists()
+    assert sys.modules['__main__'] is main
+
+
+def _keyword_soup(rng):
+    """Lower-case text dense with whole, partial and overlapping keywords."""
+    keywords = [word for words in KEYWORD_GROUPS.values() for word in words]
+    pieces = []
+    for _ in range(rng.randint(0, 12)):
+        word = rng.choice(keywords)
+        roll = rng.random()
+        if roll < 0.3:
+            word = word[:rng.randint(1, len(word))]
+        elif roll < 0.5:
+            word = word[rng.randint(0, len(word) - 1):]
+        pieces.append(word)
+        pieces.append(rng.choice(['', ' ', '  ', '-', '%', "'", ':', ' the ', ' 1 ']))
+    return ''.join(pieces)
+
+
+def test_match_counts_equals_the_keyword_list_scan():
+    # The automaton replaced one substring scan per keyword; the counts must not differ
+    rng = random.Random(6)
+    for _ in range(5000):
+        text = _keyword_soup(rng)
+        expected = {group: sum(1 for keyword in words if keyword in text)
+                    for group, words in KEYWORD_GROUPS.items()}
+        assert match_counts(KEYWORD_MATCHER, text) == expected, text
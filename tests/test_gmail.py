@@ -0,0 +1,135 @@
+import base64
+
+import pytest
+
+from conftest import GmailFake, HttpError
+from mailsort.gmail import (
+    MAX_BATCH_SIZE, BodyCache, PooledHttp, fetch_emails_concurrently, fetch_messages, fetch_new_emails,
+    get_email_body, get_emails, get_history_changes, stream_emails
+)
+
+
+def test_message_deleted_after_listing_is_left_out(gmail):
+    ids = gmail.ids[:5]
+    del gmail.messages_by_id[ids[2]]
+    emails = get_emails(gmail, 5)
+    assert [email['id'] for email in emails] == ids[:2] + ids[3:]
+
+
+def test_new_message_deleted_before_the_poll_is_left_out(gmail):
+    ids = gmail.ids[:4]
+    del gmail.messages_by_id[ids[1]]
+    assert [email['id'] for email in fetch_new_emails(gmail, ids)] == [ids[0]] + ids[2:]
+    gmail._http = PooledHttp(None)
+    assert [email['id'] for email in fetch_emails_concurrently(gmail, ids, 2)] == [ids[0]] + ids[2:]
+
+
+def test_fetch_messages_batches_in_the_order_of_ids(gmail):
+    ids = gmail.ids[::-1]
+    messages = fetch_messages(gmail, ids + ids[:3], batch_size=8)
+    assert [message['id'] for message in messages] == ids + ids[:3]
+    # Repeated ids are only fetched once
+    assert [len(batch) for batch in gmail.batches] == [8, 8, 8, 6]
+
+
+def test_fetch_messages_caps_batches_at_the_gmail_limit():
+    gmail = GmailFake(MAX_BATCH_SIZE * 2 + 50)
+    fetch_messages(gmail, gmail.ids, batch_size=1000)
+    assert [len(batch) for batch in gmail.batches] == [MAX_BATCH_SIZE, MAX_BATCH_SIZE, 50]
+
+
+def test_fetch_messages_retries_only_the_failed_sub_requests(gmail, no_backoff):
+    ids = gmail.ids[:10]
+    gmail.failures = {ids[3]: [429], ids[7]: [500, 503]}
+    messages = fetch_messages(gmail, ids, batch_size=4)
+    assert [message['id'] for message in messages] == ids
+    assert gmail.batches[3:] == [[ids[3], ids[7]], [ids[7]]]
+
+
+def test_fetch_messages_raises_other_errors_at_once(gmail, no_backoff):
+    ids = gmail.ids[:10]
+    gmail.failures = {ids[2]: [400], ids[5]: [429]}
+    with pytest.raises(HttpError) as raised:
+        fetch_messages(gmail, ids)
+    assert raised.value.resp.status == 400
+    assert len(gmail.batches) == 1
+
+
+def test_fetch_messages_gives_up_after_the_retries(gmail, no_backoff):
+    ids = gmail.ids[:5]
+    gmail.failures = {ids[1]: [503] * 10}
+    with pytest.raises(HttpError):
+        fetch_messages(gmail, ids, retries=2)
+    assert gmail.batches[1:] == [[ids[1]], [ids[1]]]
+
+
+def _msg(msg_id, *labels, thread_id=None):
+    return {'message': {'id': msg_id, 'threadId': thread_id or f't-{msg_id}', 'labelIds': list(labels)}}
+
+
+def test_history_changes(gmail):
+    gmail.history_records = [
+        {'messagesAdded': [_msg('a', 'INBOX'), _msg('b', 'INBOX'), _msg('junk', 'SPAM')]},
+        {'messagesDeleted': [_msg('b'), _msg('old1')]},
+        {'labelsAdded': [dict(_msg('old2', 'TRASH'), labelIds=['TRASH'])]},
+        {'labelsRemoved': [dict(_msg('old3', 'INBOX'), labelIds=['TRASH'])]},
+        {'messagesAdded': [_msg('c', 'INBOX')]},
+        # Labelled, but not hidden: nothing to fetch
+        {'labelsAdded': [dict(_msg('old4', 'INBOX', 'STARRED'), labelIds=['STARRED'])]},
+    ]
+    added, removed, history_id = get_history_changes(gmail, '100')
+    # Newest first, like a listing
+    assert added == ['c', 'old3', 'a']
+    assert removed == {'b', 'old1', 'old2'}
+    assert history_id == '200'
+
+
+def test_history_changes_restored_then_trashed_again(gmail):
+    gmail.history_records = [
+        {'labelsRemoved': [dict(_msg('m', 'INBOX'), labelIds=['TRASH'])]},
+        {'labelsAdded': [dict(_msg('m', 'TRASH'), labelIds=['TRASH'])]},
+    ]
+    added, removed, _ = get_history_changes(gmail, '100')
+    assert added == [] and removed == {'m'}
+
+
+def test_history_changes_by_conversation(gmail):
+    gmail.history_records = [
+        {'messagesAdded': [_msg('a', 'INBOX', thread_id='t1')]},
+        {'messagesDeleted': [_msg('b', thread_id='t2')]},
+        {'labelsAdded': [dict(_msg('c', 'TRASH', thread_id='t1'), labelIds=['TRASH'])]},
+    ]
+    added, removed, _ = get_history_changes(gmail, '100', threads=True)
+    # Every touched conversation is fetched again, the last touched first
+    assert added == ['t1', 't2'] and removed == set()
+
+
+def test_history_changes_expired(gmail):
+    errors = pytest.importorskip('googleapiclient.errors')
+    httplib2 = pytest.importorskip('httplib2')
+    gmail.history_error = errors.HttpError(httplib2.Response({'status': 404}), b'Requested entity was not found.')
+    assert get_history_changes(gmail, '1') is None
+
+
+def test_bodies_fetched_for_classification_are_not_downloaded_again(gmail):
+    text = 'Your security alert code is 123456. ' * 200
+    data = base64.urlsafe_b64encode(text.encode()).decode()
+    for message in gmail.messages_by_id.values():
+        message['payload'] = dict(message['payload'], mimeType='text/plain', body={'data': data})
+    bodies = BodyCache()
+    emails = [email for page in stream_emails(gmail, 5, body_bytes=1024, bodies=bodies) for email in page]
+    assert all(email['category'] == 'Urgent' and 'body' not in email for email in emails)
+
+    gmail.batches.clear()
+    # The whole body is kept, not just the part read for classification
+    assert get_email_body(gmail, emails[0]['id'], bodies) == text.strip()
+    assert gmail.batches == []
+
+
+def test_body_cache_evicts_the_least_recently_used():
+    bodies = BodyCache(maxsize=2)
+    bodies['a'] = 'A'
+    bodies['b'] = 'B'
+    assert bodies['a'] == 'A'
+    bodies['c'] = 'C'
+    assert list(bodies) == ['a', 'c']
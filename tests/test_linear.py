@@ -0,0 +1,32 @@
+import pytest
+
+from mailsort.classify import classify_many
+
+pytest.importorskip('numpy')
+
+from mailsort.linear import train  # noqa: E402
+
+
+def _corpus(n):
+    records = []
+    for i in range(n):
+        if i % 2:
+            records.append((f'We noticed a security alert on your account {i}', 'alerts@example.com',
+                            f'Security alert {i}'))
+        else:
+            records.append((f'This week in the newsletter {i}', 'news@example.com', f'Newsletter {i}'))
+    return records
+
+
+def test_model_reproduces_rule_labels_on_separable_corpus():
+    records = _corpus(1200)
+    held_out, training = records[::10], [r for i, r in enumerate(records) if i % 10]
+    model = train(training)
+    assert model.classify_many(held_out) == classify_many(held_out)
+
+
+def test_training_steps_stay_small():
+    model = train(_corpus(1200), epochs=1)
+    # Averaged minibatch gradients keep the first epoch from blowing up the parameters
+    assert abs(model.bias).max() < 10
+    assert abs(model.weights).max() < 10
@@ -0,0 +1,14 @@
+from mailsort.metrics import Metrics
+
+
+def test_disabled_metrics_record_nothing():
+    metrics = Metrics()
+    metrics.observe('quota_wait', 0.5)
+    metrics.count('api_calls', method='messages.get')
+    with metrics.timer('classify_email'):
+        pass
+    assert not metrics.stages and not metrics.counters
+
+    metrics.enabled = True
+    metrics.observe('quota_wait', 0.5)
+    assert metrics.stages['quota_wait'] == [1, 0.5, 0.5]
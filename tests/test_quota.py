@@ -0,0 +1,84 @@
+import pytest
+
+from conftest import HttpError
+from mailsort import quota
+from mailsort.quota import MIN_RATE, QuotaScheduler, backoff_delay, is_retryable
+
+
+class FlakyRequest:
+    def __init__(self, *statuses):
+        self.statuses = list(statuses)
+        self.calls = 0
+
+    def execute(self, **kwargs):
+        self.calls += 1
+        if self.statuses:
+            raise HttpError(self.statuses.pop(0))
+        return {'ok': True}
+
+
+def test_is_retryable():
+    assert is_retryable(HttpError(429))
+    assert is_retryable(HttpError(500))
+    assert is_retryable(HttpError(403, b'{"error": {"errors": [{"reason": "userRateLimitExceeded"}]}}'))
+    assert is_retryable(HttpError(403, '{"reason": "rateLimitExceeded"}'))
+    assert not is_retryable(HttpError(403, b'{"reason": "insufficientPermissions"}'))
+    assert not is_retryable(HttpError(404))
+    assert not is_retryable(ValueError('no response'))
+
+
+def test_backoff_delay_is_jittered_and_capped():
+    for attempt in range(12):
+        delays = [backoff_delay(attempt) for _ in range(50)]
+        assert all(0 <= delay <= min(quota.BACKOFF_MAX, quota.BACKOFF_BASE * 2 ** attempt) for delay in delays)
+
+
+def test_execute_retries_rate_limits_and_slows_down(no_backoff):
+    scheduler = QuotaScheduler(rate=1e9)
+    request = FlakyRequest(429, 503)
+    assert scheduler.execute('messages.get', request) == {'ok': True}
+    assert request.calls == 3
+    # Halved twice, then one call's worth of recovery
+    assert scheduler.user.rate == 1e9 / 4 + quota.RATE_RECOVERY
+
+
+def test_execute_gives_up_after_the_retries(no_backoff):
+    scheduler = QuotaScheduler(rate=1e9, retries=2)
+    request = FlakyRequest(429, 429, 429, 429)
+    with pytest.raises(HttpError):
+        scheduler.execute('messages.get', request)
+    assert request.calls == 3
+
+
+def test_execute_raises_other_errors_at_once(no_backoff):
+    scheduler = QuotaScheduler(rate=1e9)
+    request = FlakyRequest(400)
+    with pytest.raises(HttpError):
+        scheduler.execute('messages.get', request)
+    assert request.calls == 1
+    assert scheduler.user.rate == 1e9
+
+
+def test_throttled_rate_recovers_up_to_the_limit(no_backoff):
+    scheduler = QuotaScheduler(rate=100)
+    for attempt in range(10):
+        scheduler.throttled(attempt)
+    assert scheduler.user.rate == MIN_RATE
+    scheduler.succeeded(count=50)
+    assert scheduler.user.rate == MIN_RATE + 50 * quota.RATE_RECOVERY
+    scheduler.succeeded(count=500)
+    assert scheduler.user.rate == 100
+
+
+def test_set_project_rate_paces_to_the_share():
+    rate, capacity, tokens = quota.PROJECT_BUCKET.rate, quota.PROJECT_BUCKET.capacity, quota.PROJECT_BUCKET.tokens
+    try:
+        quota.set_project_rate(quota.PROJECT_RATE / 4)
+        assert quota.PROJECT_BUCKET.rate == quota.PROJECT_BUCKET.capacity == 5000
+        assert quota.PROJECT_BUCKET.tokens <= 5000
+        # A burst of a whole second's share waits for the next one
+        quota.PROJECT_BUCKET.acquire(5000)
+        assert quota.PROJECT_BUCKET.acquire(500) > 0
+    finally:
+        quota.PROJECT_BUCKET.rate, quota.PROJECT_BUCKET.capacity = rate, capacity
+        quota.PROJECT_BUCKET.tokens = tokens
@@ -0,0 +1,29 @@
+import base64
+
+from mailsort.classify import classify_email
+from mailsort.gmail import BODY_MAX_BYTES, extract_body
+from mailsort.text import strip_html
+
+
+def _html_payload(html):
+    data = base64.urlsafe_b64encode(html.encode()).decode().rstrip('=')
+    return {'mimeType': 'text/html', 'body': {'data': data}}
+
+
+def test_strip_html_drops_closed_blocks():
+    text = strip_html('<head><style>.a{color:red}</style></head><body><p>Hello</p></body>')
+    assert text.split() == ['Hello']
+
+
+def test_strip_html_drops_block_left_open_by_the_cap():
+    assert strip_html('<html><head><style>.deal-banner{color:red} .offer-box{').split() == []
+
+
+def test_capped_body_does_not_classify_css_as_text():
+    css = ''.join(f'.deal-banner-{i}{{color:red}} .offer-box-{i}{{margin:0}}\n' for i in range(400))
+    html = (f'<html><head><style>{css}</style></head>'
+            '<body><p>Action required: confirm the change to your account.</p></body></html>')
+    assert len(html) > 2 * BODY_MAX_BYTES
+    body = extract_body(_html_payload(html), BODY_MAX_BYTES)
+    assert 'deal' not in body and 'offer' not in body
+    assert classify_email('Please review', 'it@example.com', 'Action required', body) == 'Urgent'
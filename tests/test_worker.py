@@ -0,0 +1,33 @@
+import threading
+
+from mailsort import worker
+from mailsort.columnar import EmailColumns
+from mailsort.worker import MailboxWorker, Settings
+
+
+def test_settings_hold_until_a_restart(tmp_path, monkeypatch):
+    polled = threading.Event()
+
+    def get_history_changes(service, history_id, threads=False):
+        polled.set()
+        return [], set(), history_id
+    monkeypatch.setattr(worker, 'get_history_changes', get_history_changes)
+
+    w = MailboxWorker(object(), str(tmp_path / 'store.db'))
+    messages = Settings(poll_interval=60)
+    w.start(EmailColumns(), '1', messages)
+    assert polled.wait(5)
+    thread = w.thread
+    # Same settings: the running worker is only woken up
+    w.start(EmailColumns(), '2', messages)
+    assert w.thread is thread and w.settings is messages
+
+    # Other settings, e.g. a session grouping by conversation: a fresh thread publishes them
+    conversations = Settings(poll_interval=60, threads=True)
+    w.start(EmailColumns(), '3', conversations)
+    assert w.thread is not thread and w.settings is conversations
+    assert w.snapshot.threads and w.snapshot.history_id == '3'
+
+    w.stop()
+    assert not w.running
+    w.thread.join(5)